@@ -0,0 +1,290 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from fastapi.responses import JSONResponse
+
+from metricas import registro
+
+# =========================
+# Control de admisión de los endpoints que llaman a OpenAI
+# =========================
+# Antes de tocar Firestore u OpenAI cada solicitud pide un turno:
+# - Cubo de tokens por uid: ADMISION_RAFAGA solicitudes seguidas y luego
+#   ADMISION_TASA por segundo. Un cliente en un bucle de reintentos se corta
+#   aquí y no se lleva el límite de OpenAI de todos los demás.
+# - ADMISION_MAX_POR_USUARIO solicitudes de un mismo uid a la vez (en curso
+#   más en cola).
+# - ADMISION_MAX_CONCURRENCIA turnos en curso en total. Los que no caben
+#   esperan en una cola acotada (ADMISION_MAX_COLA) que se atiende por
+#   rondas entre usuarios, no por orden de llegada, así que una ráfaga de un
+#   usuario no deja esperando a los demás.
+# - Si la cola está llena o la espera pasa de ADMISION_ESPERA_MAX, se
+#   responde 429 con Retry-After en vez de dejar crecer la latencia.
+# - Un lote con solicitudes de varios usuarios (turno_lote) ocupa un solo
+#   lugar en la concurrencia, pero cada uid gasta de su propio cubo y cuenta
+#   en su límite. Los uid que no pasan se devuelven aparte; solo si no pasa
+#   ninguno se rechaza el lote entero.
+
+ADMISION_TASA = float(os.getenv("ADMISION_TASA", "0.5"))
+ADMISION_RAFAGA = float(os.getenv("ADMISION_RAFAGA", "5"))
+ADMISION_MAX_POR_USUARIO = int(os.getenv("ADMISION_MAX_POR_USUARIO", "2"))
+ADMISION_MAX_CONCURRENCIA = int(os.getenv("ADMISION_MAX_CONCURRENCIA", os.getenv("LLM_MAX_CONCURRENCIA", "16")))
+ADMISION_MAX_COLA = int(os.getenv("ADMISION_MAX_COLA", "64"))
+ADMISION_ESPERA_MAX = float(os.getenv("ADMISION_ESPERA_MAX", "10"))
+
+# Cubos inactivos que se recuerdan; uno que se olvida vuelve lleno
+MAX_CUBOS = 10000
+
+espera_cola = registro.histograma("admision_espera_segundos", "Tiempo en la cola de admisión")
+
+
+class AdmisionRechazada(Exception):
+    def __init__(self, motivo: str, reintentar_en: float):
+        super().__init__(f"Demasiadas solicitudes ({motivo}). Intenta de nuevo en unos segundos.")
+        self.motivo = motivo
+        self.reintentar_en = max(1, math.ceil(reintentar_en))
+
+
+class CuboTokens:
+    def __init__(self, capacidad: float, tasa: float):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self.tokens = capacidad
+        self.actualizado = time.monotonic()
+
+    def tomar(self) -> float:
+        # 0 si hay token; si no, segundos hasta que haya uno
+        ahora = time.monotonic()
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.tasa
+
+    def devolver(self):
+        self.tokens = min(self.capacidad, self.tokens + 1)
+
+
+class Turno:
+    def __init__(self, control, uids: tuple):
+        self._control = control
+        self.uids = uids
+        self.uid = uids[0]
+        self.inicio = time.monotonic()
+        self._liberado = False
+
+    @property
+    def liberado(self) -> bool:
+        return self._liberado
+
+    def liberar(self):
+        # Idempotente: el stream lo libera al terminar y el finally por si acaso
+        if not self._liberado:
+            self._liberado = True
+            self._control._liberar(self)
+
+
+class ControlAdmision:
+    def __init__(self, tasa: float, rafaga: float, max_por_usuario: int, max_concurrencia: int, max_cola: int, espera_max: float):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.max_por_usuario = max_por_usuario
+        self.max_concurrencia = max_concurrencia
+        self.max_cola = max_cola
+        self.espera_max = espera_max
+        self._cubos = OrderedDict()
+        self._por_usuario = {}
+        # uid -> futuros en espera; el orden de las claves es el orden de la ronda
+        self._cola = OrderedDict()
+        self._en_cola = 0
+        self._en_curso = 0
+        self._duracion_media = 1.0
+        self.admitidas = 0
+        self.encoladas = 0
+        self.rechazadas = {}
+
+    def _cubo(self, uid: str) -> CuboTokens:
+        cubo = self._cubos.get(uid)
+        if cubo is None:
+            cubo = self._cubos[uid] = CuboTokens(self.rafaga, self.tasa)
+            while len(self._cubos) > MAX_CUBOS:
+                self._cubos.popitem(last=False)
+        else:
+            self._cubos.move_to_end(uid)
+        return cubo
+
+    def _espera_estimada(self) -> float:
+        return self._duracion_media * (self._en_cola + 1) / self.max_concurrencia
+
+    def _rechazo(self, motivo: str, reintentar_en: float) -> AdmisionRechazada:
+        self.rechazadas[motivo] = self.rechazadas.get(motivo, 0) + 1
+        return AdmisionRechazada(motivo, reintentar_en)
+
+    def _rechazar(self, motivo: str, reintentar_en: float):
+        raise self._rechazo(motivo, reintentar_en)
+
+    def _sumar_usuario(self, uid: str, cantidad: int):
+        total = self._por_usuario.get(uid, 0) + cantidad
+        if total > 0:
+            self._por_usuario[uid] = total
+        else:
+            self._por_usuario.pop(uid, None)
+
+    async def entrar(self, uid: str) -> Turno:
+        turno, _ = await self.entrar_varios([uid])
+        return turno
+
+    async def entrar_varios(self, uids: list):
+        # uids sin repetir. Devuelve (turno de los uid admitidos, { uid: AdmisionRechazada } de los demás).
+        # Si no se admite ninguno se lanza el rechazo del primero.
+        rechazos = {}
+        for uid in uids:
+            if self._por_usuario.get(uid, 0) >= self.max_por_usuario:
+                rechazos[uid] = self._rechazo("usuario", self._duracion_media)
+        if len(rechazos) == len(uids):
+            raise rechazos[uids[0]]
+
+        hay_cupo = self._en_curso < self.max_concurrencia and not self._en_cola
+        if not hay_cupo and self._en_cola >= self.max_cola:
+            self._rechazar("cola_llena", self._espera_estimada())
+
+        cubos = {}
+        for uid in uids:
+            if uid in rechazos:
+                continue
+            cubo = self._cubo(uid)
+            espera = cubo.tomar()
+            if espera:
+                rechazos[uid] = self._rechazo("tasa", espera)
+            else:
+                cubos[uid] = cubo
+
+        admitidos = tuple(cubos)
+        if not admitidos:
+            raise rechazos[uids[0]]
+
+        for uid in admitidos:
+            self._sumar_usuario(uid, 1)
+        if hay_cupo:
+            self._en_curso += 1
+            self.admitidas += 1
+            return Turno(self, admitidos), rechazos
+
+        # El lote espera en la ronda de su primer uid
+        clave = admitidos[0]
+        futuro = asyncio.get_running_loop().create_future()
+        self._cola.setdefault(clave, deque()).append(futuro)
+        self._en_cola += 1
+        self.encoladas += 1
+        inicio = time.monotonic()
+
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), self.espera_max)
+        except BaseException as e:
+            if futuro.done():
+                # Le tocó el cupo justo al vencer la espera o al desconectarse: se pasa al siguiente
+                self._liberar_cupo()
+            else:
+                futuro.cancel()
+                self._quitar_de_cola(clave, futuro)
+            for uid in admitidos:
+                self._sumar_usuario(uid, -1)
+            if isinstance(e, asyncio.TimeoutError):
+                for cubo in cubos.values():
+                    cubo.devolver()
+                self._rechazar("espera", self._espera_estimada())
+            raise
+        finally:
+            espera_cola.observar(time.monotonic() - inicio)
+
+        self.admitidas += 1
+        return Turno(self, admitidos), rechazos
+
+    @asynccontextmanager
+    async def turno(self, uid: str):
+        turno = await self.entrar(uid)
+        try:
+            yield turno
+        finally:
+            turno.liberar()
+
+    @asynccontextmanager
+    async def turno_lote(self, uids: list):
+        # Un solo turno para un lote de varios usuarios; entrega (turno, rechazos)
+        turno, rechazos = await self.entrar_varios(uids)
+        try:
+            yield turno, rechazos
+        finally:
+            turno.liberar()
+
+    def _quitar_de_cola(self, uid: str, futuro):
+        cola = self._cola.get(uid)
+        if cola is None or futuro not in cola:
+            return
+        cola.remove(futuro)
+        self._en_cola -= 1
+        if not cola:
+            del self._cola[uid]
+
+    def _siguiente(self) -> bool:
+        # Un turno por usuario y por ronda
+        while self._cola:
+            uid, cola = next(iter(self._cola.items()))
+            futuro = cola.popleft()
+            self._en_cola -= 1
+            if cola:
+                self._cola.move_to_end(uid)
+            else:
+                del self._cola[uid]
+            if not futuro.done():
+                futuro.set_result(None)
+                return True
+        return False
+
+    def _liberar_cupo(self):
+        # El cupo pasa directo al siguiente en la cola; si no hay nadie, se libera
+        if not self._siguiente():
+            self._en_curso -= 1
+
+    def _liberar(self, turno: Turno):
+        self._duracion_media = 0.9 * self._duracion_media + 0.1 * (time.monotonic() - turno.inicio)
+        for uid in turno.uids:
+            self._sumar_usuario(uid, -1)
+        self._liberar_cupo()
+
+    def estadisticas(self) -> dict:
+        return {
+            "en_curso": self._en_curso,
+            "en_cola": self._en_cola,
+            "usuarios_en_cola": len(self._cola),
+            "admitidas": self.admitidas,
+            "encoladas": self.encoladas,
+            "rechazadas": dict(self.rechazadas),
+            "duracion_media": self._duracion_media
+        }
+
+
+admision = ControlAdmision(
+    tasa=ADMISION_TASA,
+    rafaga=ADMISION_RAFAGA,
+    max_por_usuario=ADMISION_MAX_POR_USUARIO,
+    max_concurrencia=ADMISION_MAX_CONCURRENCIA,
+    max_cola=ADMISION_MAX_COLA,
+    espera_max=ADMISION_ESPERA_MAX,
+)
+
+
+def instalar_rechazos(app):
+    # Cualquier endpoint que pida turno responde 429 con Retry-After si se rechaza
+    @app.exception_handler(AdmisionRechazada)
+    async def responder_rechazo(request, exc: AdmisionRechazada):
+        return JSONResponse(
+            { "detail": str(exc), "motivo": exc.motivo },
+            status_code=429,
+            headers={ "Retry-After": str(exc.reintentar_en) }
+        )
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+
+from documentos_largos import combinar_preguntas
+from normalizacion import palabras
+
+# =========================
+# Banco de preguntas por textos casi iguales
+# =========================
+# La caché de resultados solo sirve si el texto es idéntico. Muchos textos
+# son la misma sección del libro con cambios mínimos (un párrafo de más, otra
+# puntuación). El banco guarda cada resultado válido (preguntas, materia y
+# tokens que costó) con una firma MinHash del texto, y un texto nuevo cuya
+# similitud estimada con uno guardado pasa de BANCO_UMBRAL reutiliza sus
+# preguntas (completadas con las de otros textos parecidos si faltan) sin
+# llamar a gpt-4o. Se cobra lo que costó la generación original.
+#
+# Firma: trigramas de palabras (minúsculas, sin acentos) con "one permutation
+# hashing": un solo hash por trigrama repartido en NUM_CUBETAS cubetas, que
+# se queda con el mínimo de cada una. Las cubetas vacías toman el valor de la
+# siguiente con datos. La similitud es la fracción de cubetas iguales.
+#
+# Índice LSH: la firma se parte en BANDAS de FILAS cubetas; dos textos son
+# candidatos si coinciden en una banda completa. Con 32 x 4, un par con
+# similitud 0.75 es candidato prácticamente siempre y uno con 0.3, el 23 %.
+# Los candidatos se ordenan por bandas en común y solo se comparan las
+# firmas completas de los primeros MAX_CANDIDATOS. Las bandas viven en
+# SQLite con índice, así que la consulta son unas decenas de lecturas de
+# B-tree aunque haya cientos de miles de entradas, y el banco sobrevive a los
+# reinicios.
+
+BANCO_RUTA = os.getenv("BANCO_RUTA", "banco_preguntas.db")
+BANCO_UMBRAL = float(os.getenv("BANCO_UMBRAL", "0.75"))
+BANCO_MAX_ENTRADAS = int(os.getenv("BANCO_MAX_ENTRADAS", "300000"))
+# En textos muy cortos la similitud estimada no es confiable
+BANCO_MIN_PALABRAS = int(os.getenv("BANCO_MIN_PALABRAS", "40"))
+
+TAMANO_TRIGRAMA = 3
+NUM_CUBETAS = 128
+BANDAS = 32
+FILAS = NUM_CUBETAS // BANDAS
+MAX_CANDIDATOS = 32
+
+# Los valores ocupan 57 bits; la distancia al rellenar cubetas vacías va arriba
+BITS_VALOR = 57
+VACIA = 1 << 64
+
+
+def _hash64(datos: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(datos, digest_size=8).digest(), "little")
+
+
+def calcular_firma(texto: str):
+    # Devuelve array('Q') con NUM_CUBETAS valores, o None si el texto es muy corto
+    lista = palabras(texto)
+    if len(lista) < BANCO_MIN_PALABRAS:
+        return None
+
+    trigramas = { " ".join(lista[i:i + TAMANO_TRIGRAMA]) for i in range(len(lista) - TAMANO_TRIGRAMA + 1) }
+    minimos = [VACIA] * NUM_CUBETAS
+    for trigrama in trigramas:
+        h = _hash64(trigrama.encode("utf-8"))
+        # Con 128 cubetas quedan 57 bits de valor
+        cubeta, valor = h % NUM_CUBETAS, h // NUM_CUBETAS
+        if valor < minimos[cubeta]:
+            minimos[cubeta] = valor
+
+    # Densificación: la cubeta vacía copia la siguiente con datos, marcada con la distancia
+    for cubeta in range(NUM_CUBETAS):
+        if minimos[cubeta] != VACIA:
+            continue
+        for distancia in range(1, NUM_CUBETAS):
+            origen = minimos[(cubeta + distancia) % NUM_CUBETAS]
+            if origen != VACIA and origen < (1 << BITS_VALOR):
+                minimos[cubeta] = (distancia << BITS_VALOR) | origen
+                break
+    return array("Q", minimos)
+
+
+def similitud(firma_a, firma_b) -> float:
+    return sum(a == b for a, b in zip(firma_a, firma_b)) / NUM_CUBETAS
+
+
+def _claves_bandas(firma, version: str) -> list:
+    # Incluyen la versión: un prompt o modelo nuevo no reutiliza preguntas viejas
+    prefijo = version.encode("utf-8")
+    return [
+        _hash64(prefijo + bytes([banda]) + firma[banda * FILAS:(banda + 1) * FILAS].tobytes()) >> 1
+        for banda in range(BANDAS)
+    ]
+
+
+class BancoPreguntas:
+    def __init__(self, ruta: str, umbral: float = BANCO_UMBRAL, max_entradas: int = BANCO_MAX_ENTRADAS):
+        self.ruta = ruta
+        self.umbral = umbral
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._conexion = None
+        self._entradas = 0
+        self._escrituras = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.omitidas = 0
+
+    def _db(self):
+        if self._conexion is None:
+            self._conexion = sqlite3.connect(self.ruta, check_same_thread=False)
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute("PRAGMA synchronous=NORMAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS entradas ("
+                " id INTEGER PRIMARY KEY,"
+                " version TEXT NOT NULL,"
+                " firma BLOB NOT NULL,"
+                " preguntas TEXT NOT NULL,"
+                " materia TEXT,"
+                " tokens_usados INTEGER NOT NULL,"
+                " creado REAL NOT NULL,"
+                " usado REAL NOT NULL)"
+            )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_entradas_usado ON entradas (usado)")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS bandas ("
+                " clave INTEGER NOT NULL,"
+                " id INTEGER NOT NULL,"
+                " PRIMARY KEY (clave, id)) WITHOUT ROWID"
+            )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_bandas_id ON bandas (id)")
+            self._entradas = self._conexion.execute("SELECT COUNT(*) FROM entradas").fetchone()[0]
+        return self._conexion
+
+    def buscar(self, texto: str, version: str, max_preguntas: int):
+        # Devuelve { preguntas, materia, tokens_usados, similitud } o None
+        firma = calcular_firma(texto)
+        if firma is None:
+            self.omitidas += 1
+            return None
+        claves = _claves_bandas(firma, version)
+
+        with self._lock:
+            db = self._db()
+            ids = [fila[0] for fila in db.execute(
+                f"SELECT id FROM bandas WHERE clave IN ({','.join('?' * len(claves))})"
+                f" GROUP BY id ORDER BY COUNT(*) DESC LIMIT {MAX_CANDIDATOS}",
+                claves
+            )]
+            filas = db.execute(
+                f"SELECT id, firma, preguntas, materia, tokens_usados FROM entradas"
+                f" WHERE id IN ({','.join('?' * len(ids))}) AND version = ?",
+                ids + [version]
+            ).fetchall() if ids else []
+
+            parecidas = []
+            for fila in filas:
+                grado = similitud(firma, array("Q", fila[1]))
+                if grado >= self.umbral:
+                    parecidas.append((grado, fila))
+
+            if not parecidas:
+                self.fallos += 1
+                return None
+
+            parecidas.sort(key=lambda parecida: parecida[0], reverse=True)
+            grado, mejor = parecidas[0]
+            db.execute("UPDATE entradas SET usado = ? WHERE id = ?", (time.time(), mejor[0]))
+            db.commit()
+            self.aciertos += 1
+
+        preguntas = json.loads(mejor[2])
+        if len(preguntas) < max_preguntas and len(parecidas) > 1:
+            # Se completan con las de los otros textos parecidos, sin repetir
+            todas = preguntas + [p for _, fila in parecidas[1:] for p in json.loads(fila[2])]
+            preguntas = combinar_preguntas([todas], max_preguntas)
+
+        return { "preguntas": preguntas, "materia": mejor[3], "tokens_usados": mejor[4], "similitud": round(grado, 3) }
+
+    def guardar(self, texto: str, version: str, preguntas: list, materia, tokens_usados: int):
+        firma = calcular_firma(texto)
+        if firma is None or not preguntas:
+            return
+
+        ahora = time.time()
+        try:
+            with self._lock:
+                db = self._db()
+                cursor = db.execute(
+                    "INSERT INTO entradas (version, firma, preguntas, materia, tokens_usados, creado, usado)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (version, firma.tobytes(), json.dumps(preguntas, ensure_ascii=False), materia, tokens_usados, ahora, ahora)
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO bandas (clave, id) VALUES (?, ?)",
+                    [(clave, cursor.lastrowid) for clave in _claves_bandas(firma, version)]
+                )
+                self._entradas += 1
+                self._escrituras += 1
+                if self._escrituras % 256 == 1:
+                    self._desalojar(db)
+                db.commit()
+        except sqlite3.Error as e:
+            print("❌ No se pudo guardar en el banco de preguntas:", str(e))
+
+    def _desalojar(self, db):
+        # Se van las menos usadas recientemente
+        sobrantes = self._entradas - self.max_entradas
+        if sobrantes <= 0:
+            return
+        ids = [fila[0] for fila in db.execute("SELECT id FROM entradas ORDER BY usado ASC LIMIT ?", (sobrantes,))]
+        db.executemany("DELETE FROM bandas WHERE id = ?", [(i,) for i in ids])
+        db.executemany("DELETE FROM entradas WHERE id = ?", [(i,) for i in ids])
+        self._entradas -= len(ids)
+
+    def estadisticas(self) -> dict:
+        consultas = self.aciertos + self.fallos
+        return {
+            "entradas": self._entradas,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "omitidas": self.omitidas,
+            "tasa_aciertos": self.aciertos / consultas if consultas else 0.0
+        }
+
+
+banco_preguntas = BancoPreguntas(BANCO_RUTA)
@@ -0,0 +1,344 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import uuid
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+from benchmark.firestore_memoria import FirestoreMemoria, transactional
+from benchmark.servicios_falsos import ServiciosFalsos
+
+# =========================
+# Benchmark sin red
+# =========================
+# Levanta las dos apps (archivo.app y paypal_webhook.app) en el mismo proceso,
+# con Firestore en memoria y OpenAI / PayPal falsos en un servidor local, y les
+# manda solicitudes a distintos niveles de concurrencia con httpx.ASGITransport.
+# Reporta throughput y latencias p50 / p95 / p99 por escenario.
+#
+# Uso (desde la raíz del repo; necesita httpx):
+#   python -m benchmark.ejecutar
+#   python -m benchmark.ejecutar --escenarios generar,clasificar --concurrencia 1,16,64 --solicitudes 500
+#   python -m benchmark.ejecutar --latencia-openai 1.5 --fallos-openai 0.05 --json resultados.json
+
+ESCENARIOS = ("generar", "contar_tokens", "clasificar", "webhook_paypal", "webhook_ipn", "paypal_success")
+SALDO_INICIAL = 10 ** 9
+
+PALABRAS = (
+    "la revolución francesa comenzó en 1789 con la toma de la bastilla y transformó la monarquía absoluta "
+    "los ilustrados defendieron la razón la división de poderes y los derechos del ciudadano frente al rey "
+    "la asamblea nacional redactó una constitución y abolió los privilegios feudales de la nobleza y el clero "
+    "napoleón bonaparte llegó al poder con un golpe de estado y expandió el código civil por europa"
+).split()
+
+
+def _texto(semilla: int, palabras: int) -> str:
+    aleatorio = random.Random(semilla)
+    return " ".join(aleatorio.choice(PALABRAS) for _ in range(palabras)) + f". Documento {semilla}."
+
+
+def _percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    posicion = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[posicion]
+
+
+# =========================
+# Preparación del entorno
+# =========================
+
+def preparar_entorno(args, directorio: str, url_servicios: str, db: FirestoreMemoria):
+    # Todo lo que lee os.getenv al importar la app va antes de importarla
+    os.environ.setdefault("API_KEY", "sk-benchmark")
+    os.environ["PAYPAL_API_BASE"] = url_servicios
+    os.environ.setdefault("PAYPAL_CLIENT_ID", "benchmark")
+    os.environ.setdefault("PAYPAL_CLIENT_SECRET", "benchmark")
+    os.environ["PAYPAL_WEBHOOK_ID"] = "benchmark"
+    os.environ["CACHE_RUTA"] = os.path.join(directorio, "cache_resultados.db")
+    os.environ["COLA_WEBHOOKS_RUTA"] = os.path.join(directorio, "cola_webhooks.db")
+    os.environ["INDICE_CLASIFICACION_RUTA"] = os.path.join(directorio, "indice_clasificacion.json")
+    os.environ["BANCO_RUTA"] = os.path.join(directorio, "banco_preguntas.db")
+    if not args.limites_por_usuario:
+        # Pocos usuarios simulados mandan muchas solicitudes: sin esto casi todo sería 429
+        os.environ["ADMISION_TASA"] = "1000000"
+        os.environ["ADMISION_RAFAGA"] = "1000000"
+        os.environ["ADMISION_MAX_POR_USUARIO"] = "1000000"
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    credentials.Certificate = lambda ruta: None
+    firebase_admin.initialize_app = lambda *a, **k: firebase_admin._apps.setdefault("[DEFAULT]", None)
+    firestore.client = lambda *a, **k: db
+    firestore.transactional = transactional
+
+    import openai
+    openai.api_base = f"{url_servicios}/v1"
+
+    import tokenizador
+    from recursos import RecursoPerezoso
+    try:
+        tokenizador.precargar()
+    except Exception as e:
+        # Sin red y sin las tablas BPE en caché no se puede cargar tiktoken
+        if not args.tokenizador_aproximado:
+            raise SystemExit(
+                f"No se pudo cargar tiktoken ({e}). Configura TIKTOKEN_CACHE_DIR con las tablas "
+                "descargadas o usa --tokenizador-aproximado."
+            )
+        print("⚠️ tiktoken no disponible, se usa un conteo aproximado de tokens.")
+        tokenizador.recurso_codificador = RecursoPerezoso("tokenizador", CodificadorAproximado)
+
+
+class CodificadorAproximado:
+    # Solo para medir la app sin las tablas BPE: ~1 token por palabra o signo
+    def encode_ordinary(self, texto: str) -> list:
+        return re.findall(r"\w+|[^\w\s]", texto)
+
+    encode = encode_ordinary
+
+    def encode_ordinary_batch(self, textos: list, num_threads: int = 8) -> list:
+        return [self.encode_ordinary(texto) for texto in textos]
+
+    def decode(self, tokens: list) -> str:
+        return " ".join(tokens)
+
+
+# =========================
+# Escenarios
+# =========================
+# Cada escenario devuelve (app, método, url, kwargs de httpx, validador).
+
+def _ok(respuesta) -> bool:
+    return respuesta.status_code < 400
+
+
+def construir_escenario(nombre: str, args):
+    usuarios = [f"bench-{i}" for i in range(args.usuarios)]
+
+    def uid(i: int) -> str:
+        return usuarios[i % len(usuarios)]
+
+    def semilla(i: int) -> int:
+        # Con --textos-distintos N se repiten N textos y la caché empieza a acertar
+        return i % args.textos_distintos if args.textos_distintos else i + random.randrange(10 ** 9)
+
+    if nombre == "generar":
+        return lambda i: ("api", "POST", "/generate-questions/", {
+            "json": { "uid": uid(i), "texto": _texto(semilla(i), args.palabras) }
+        }, _ok)
+
+    if nombre == "contar_tokens":
+        return lambda i: ("api", "POST", "/contar-tokens/", {
+            "json": { "texto": _texto(semilla(i), args.palabras) }
+        }, _ok)
+
+    if nombre == "clasificar":
+        def clasificar(i):
+            texto = _texto(semilla(i), 20)
+            return ("api", "POST", "/clasificar-palabras-clave/", {
+                "json": { "uid": uid(i), "contenido": [texto, "Revolución Francesa"] }
+            }, lambda r: _ok(r) and "error" not in r.json())
+        return clasificar
+
+    if nombre == "webhook_paypal":
+        def webhook_paypal(i):
+            orden = uuid.uuid4().hex
+            evento = {
+                "id": f"WH-{orden}",
+                "event_type": "CHECKOUT.ORDER.COMPLETED",
+                "resource": {
+                    "id": orden,
+                    "purchase_units": [{ "amount": { "value": "1.00" }, "custom_id": uid(i) }]
+                }
+            }
+            return ("api", "POST", "/paypal/webhook/", { "json": evento }, _ok)
+        return webhook_paypal
+
+    if nombre == "webhook_ipn":
+        return lambda i: ("ipn", "POST", "/paypal/webhook/", {
+            "data": { "payment_status": "Completed", "mc_gross": "5.00", "custom": uid(i), "txn_id": uuid.uuid4().hex }
+        }, _ok)
+
+    if nombre == "paypal_success":
+        return lambda i: ("api", "GET", "/paypal/success", {
+            "params": { "token": f"{uid(i)}:10.00:{uuid.uuid4().hex}" }
+        }, lambda r: "pago-exitoso" in r.headers.get("location", ""))
+
+    raise SystemExit(f"Escenario desconocido: {nombre}")
+
+
+async def correr_nivel(clientes: dict, escenario, concurrencia: int, solicitudes: int) -> dict:
+    latencias = []
+    errores = 0
+    rechazadas = 0
+    siguiente = 0
+
+    async def trabajador():
+        nonlocal errores, rechazadas, siguiente
+        while siguiente < solicitudes:
+            i = siguiente
+            siguiente += 1
+            app, metodo, url, kwargs, valido = escenario(i)
+            inicio = time.perf_counter()
+            try:
+                respuesta = await clientes[app].request(metodo, url, **kwargs)
+                exito = valido(respuesta)
+                rechazadas += respuesta.status_code == 429
+            except Exception:
+                exito = False
+            latencias.append(time.perf_counter() - inicio)
+            if not exito:
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    return {
+        "concurrencia": concurrencia,
+        "solicitudes": solicitudes,
+        "errores": errores,
+        "rechazadas_429": rechazadas,
+        "duracion_s": round(duracion, 3),
+        "throughput_rps": round(solicitudes / duracion, 2) if duracion else 0.0,
+        "p50_ms": round(_percentil(latencias, 50) * 1000, 2),
+        "p95_ms": round(_percentil(latencias, 95) * 1000, 2),
+        "p99_ms": round(_percentil(latencias, 99) * 1000, 2),
+    }
+
+
+async def esperar_cola(cola, limite: float = 120.0) -> float:
+    # Tiempo hasta que los trabajadores terminan de acreditar los webhooks encolados
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite:
+        por_estado = (await asyncio.to_thread(cola.estadisticas))["por_estado"]
+        if not por_estado.get("pendiente") and not por_estado.get("procesando"):
+            break
+        await asyncio.sleep(0.05)
+    return round(time.perf_counter() - inicio, 3)
+
+
+# =========================
+# Principal
+# =========================
+
+async def principal(args) -> list:
+    import httpx
+
+    import archivo
+    import paypal_webhook
+
+    for i in range(args.usuarios):
+        archivo.db.sembrar(f"usuarios/bench-{i}", { "tokens": SALDO_INICIAL })
+
+    resultados = []
+    async with archivo.app.router.lifespan_context(archivo.app), \
+            paypal_webhook.app.router.lifespan_context(paypal_webhook.app):
+        clientes = {
+            "api": httpx.AsyncClient(transport=httpx.ASGITransport(app=archivo.app), base_url="http://api", timeout=None),
+            "ipn": httpx.AsyncClient(transport=httpx.ASGITransport(app=paypal_webhook.app), base_url="http://ipn", timeout=None),
+        }
+        colas = { "webhook_paypal": archivo.cola_webhooks, "webhook_ipn": paypal_webhook.cola_webhooks }
+
+        try:
+            for nombre in args.escenarios:
+                escenario = construir_escenario(nombre, args)
+                for concurrencia in args.concurrencia:
+                    salida = io.StringIO() if not args.detalle else sys.stdout
+                    with contextlib.redirect_stdout(salida):
+                        resultado = await correr_nivel(clientes, escenario, concurrencia, args.solicitudes)
+                        if nombre in colas:
+                            resultado["cola_drenada_s"] = await esperar_cola(colas[nombre])
+                    resultado["escenario"] = nombre
+                    resultados.append(resultado)
+                    imprimir_fila(resultado)
+        finally:
+            for cliente in clientes.values():
+                await cliente.aclose()
+
+    return resultados
+
+
+COLUMNAS = ("escenario", "concurrencia", "solicitudes", "errores", "rechazadas_429", "throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def imprimir_encabezado():
+    print(" ".join(f"{columna:>15}" for columna in COLUMNAS))
+
+
+def imprimir_fila(resultado: dict):
+    fila = " ".join(f"{resultado[columna]:>15}" for columna in COLUMNAS)
+    if "cola_drenada_s" in resultado:
+        fila += f"   (cola drenada en {resultado['cola_drenada_s']} s)"
+    print(fila, flush=True)
+
+
+def _lista(tipo):
+    return lambda valor: [tipo(parte) for parte in valor.split(",") if parte]
+
+
+def leer_argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark sin red de la API de QuizForge.")
+    parser.add_argument("--escenarios", type=_lista(str), default=list(ESCENARIOS))
+    parser.add_argument("--concurrencia", type=_lista(int), default=[1, 8, 32])
+    parser.add_argument("--solicitudes", type=int, default=200, help="Solicitudes por nivel de concurrencia")
+    parser.add_argument("--usuarios", type=int, default=50)
+    parser.add_argument("--palabras", type=int, default=300, help="Largo de los textos enviados")
+    parser.add_argument("--textos-distintos", type=int, default=0, help="0 = todos distintos (sin aciertos de caché)")
+    parser.add_argument("--latencia-openai", type=float, default=0.5)
+    parser.add_argument("--fallos-openai", type=float, default=0.0)
+    parser.add_argument("--latencia-paypal", type=float, default=0.2)
+    parser.add_argument("--fallos-paypal", type=float, default=0.0)
+    parser.add_argument("--latencia-firestore", type=float, default=0.02)
+    parser.add_argument("--fallos-firestore", type=float, default=0.0)
+    parser.add_argument("--limites-por-usuario", action="store_true",
+                        help="Aplicar los límites de admisión por uid (ADMISION_*) en vez de desactivarlos")
+    parser.add_argument("--tokenizador-aproximado", action="store_true",
+                        help="Si tiktoken no puede cargar sus tablas, contar tokens de forma aproximada")
+    parser.add_argument("--detalle", action="store_true", help="No ocultar los print de la app")
+    parser.add_argument("--json", help="Guardar los resultados en este archivo")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = leer_argumentos(argv)
+
+    servicios = ServiciosFalsos(
+        latencia_openai=args.latencia_openai,
+        fallos_openai=args.fallos_openai,
+        latencia_paypal=args.latencia_paypal,
+        fallos_paypal=args.fallos_paypal,
+    )
+    db = FirestoreMemoria(latencia=args.latencia_firestore, tasa_fallos=args.fallos_firestore)
+
+    with tempfile.TemporaryDirectory(prefix="quizforge-bench-") as directorio:
+        url = servicios.iniciar()
+        try:
+            preparar_entorno(args, directorio, url, db)
+            imprimir_encabezado()
+            resultados = asyncio.run(principal(args))
+        finally:
+            servicios.detener()
+
+    print(f"\nLlamadas a servicios falsos: {servicios.llamadas} | viajes a Firestore: {db.viajes}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo_salida:
+            json.dump(resultados, archivo_salida, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import copy
+import itertools
+import random
+import threading
+import time
+
+from google.api_core.exceptions import AlreadyExists, NotFound, ServiceUnavailable
+from google.cloud.firestore_v1 import transforms
+
+# =========================
+# Firestore en memoria para el benchmark
+# =========================
+# Implementa lo que usa la app: colecciones y subcolecciones, get / get_all /
+# set(merge) / update (rutas con puntos) / create / delete, Increment,
+# SERVER_TIMESTAMP, DELETE_FIELD, WriteBatch, transacciones, on_snapshot y
+# consultas de grupo de colecciones con where (==, <, <=, >, >=) y limit.
+# Cada viaje a "Firestore" duerme `latencia` segundos (bloqueando el hilo,
+# como el cliente real) y falla con probabilidad `tasa_fallos`.
+
+_ids = itertools.count()
+
+
+def _aplicar(datos: dict, ruta: str, valor):
+    partes = ruta.split(".")
+    actual = datos
+    for parte in partes[:-1]:
+        actual = actual.setdefault(parte, {})
+    ultima = partes[-1]
+
+    if isinstance(valor, transforms.Increment):
+        actual[ultima] = actual.get(ultima, 0) + valor.value
+    elif valor is transforms.SERVER_TIMESTAMP:
+        actual[ultima] = time.time()
+    elif valor is transforms.DELETE_FIELD:
+        actual.pop(ultima, None)
+    else:
+        actual[ultima] = copy.deepcopy(valor)
+
+
+def _aplanar(datos: dict, prefijo: str):
+    for clave, valor in datos.items():
+        ruta = f"{prefijo}.{clave}"
+        if isinstance(valor, dict):
+            yield from _aplanar(valor, ruta)
+        else:
+            yield ruta, valor
+
+
+class Instantanea:
+    def __init__(self, referencia, datos):
+        self.reference = referencia
+        self.id = referencia.id
+        self._datos = datos
+        self.exists = datos is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._datos) if self._datos is not None else None
+
+    def get(self, campo: str):
+        datos = self._datos
+        for parte in campo.split("."):
+            datos = datos[parte]
+        return datos
+
+
+class Documento:
+    def __init__(self, db, ruta: str):
+        self._db = db
+        self.path = ruta
+        self.id = ruta.rsplit("/", 1)[-1]
+
+    def collection(self, nombre: str):
+        return Coleccion(self._db, f"{self.path}/{nombre}")
+
+    # ---- Operaciones sin viaje (las usan los batch y transacciones) ----
+
+    def _set(self, datos: dict, merge: bool = False):
+        actual = self._db._docs.get(self.path)
+        base = copy.deepcopy(actual) if merge and actual else {}
+        for clave, valor in datos.items():
+            if merge and isinstance(valor, dict):
+                for ruta, subvalor in _aplanar(valor, clave):
+                    _aplicar(base, ruta, subvalor)
+            else:
+                _aplicar(base, clave, valor)
+        self._db._docs[self.path] = base
+        self._db._notificar(self)
+
+    def _update(self, datos: dict):
+        actual = self._db._docs.get(self.path)
+        if actual is None:
+            raise NotFound(f"No document to update: {self.path}")
+        for clave, valor in datos.items():
+            _aplicar(actual, clave, valor)
+        self._db._notificar(self)
+
+    def _create(self, datos: dict):
+        if self.path in self._db._docs:
+            raise AlreadyExists(f"Document already exists: {self.path}")
+        self._set(datos)
+
+    def _delete(self):
+        self._db._docs.pop(self.path, None)
+        self._db._notificar(self)
+
+    # ---- API pública ----
+
+    def get(self, transaction=None, **kwargs):
+        # Dentro de una transacción el viaje ya se contó al empezarla
+        if transaction is None:
+            self._db._viaje()
+        with self._db._lock:
+            return Instantanea(self, copy.deepcopy(self._db._docs.get(self.path)))
+
+    def set(self, datos: dict, merge: bool = False):
+        self._db._viaje()
+        with self._db._lock:
+            self._set(datos, merge)
+
+    def update(self, datos: dict):
+        self._db._viaje()
+        with self._db._lock:
+            self._update(datos)
+
+    def create(self, datos: dict):
+        self._db._viaje()
+        with self._db._lock:
+            self._create(datos)
+
+    def delete(self):
+        self._db._viaje()
+        with self._db._lock:
+            self._delete()
+
+    def on_snapshot(self, callback):
+        return self._db._escuchar(self, callback)
+
+
+class Coleccion:
+    def __init__(self, db, ruta: str):
+        self._db = db
+        self.path = ruta
+
+    def document(self, doc_id: str = None):
+        return Documento(self._db, f"{self.path}/{doc_id or 'auto%d' % next(_ids)}")
+
+    def add(self, datos: dict):
+        referencia = self.document()
+        referencia.set(datos)
+        return None, referencia
+
+    def stream(self):
+        self._db._viaje()
+        prefijo = self.path + "/"
+        with self._db._lock:
+            return [
+                Instantanea(Documento(self._db, ruta), copy.deepcopy(datos))
+                for ruta, datos in self._db._docs.items()
+                if ruta.startswith(prefijo) and "/" not in ruta[len(prefijo):]
+            ]
+
+
+def _comparable(valor):
+    # SERVER_TIMESTAMP se guarda como float; las consultas pueden traer datetime
+    return valor.timestamp() if hasattr(valor, "timestamp") else valor
+
+
+_OPERADORES = {
+    "==": lambda a, b: a == b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b
+}
+
+
+class Consulta:
+    def __init__(self, db, coleccion: str, filtros: tuple = (), limite: int = None):
+        self._db = db
+        self._coleccion = coleccion
+        self._filtros = filtros
+        self._limite = limite
+
+    def where(self, filter):
+        return Consulta(self._db, self._coleccion, self._filtros + (filter,), self._limite)
+
+    def limit(self, limite: int):
+        return Consulta(self._db, self._coleccion, self._filtros, limite)
+
+    def _cumple(self, datos: dict) -> bool:
+        for filtro in self._filtros:
+            if filtro.field_path not in datos:
+                return False
+            valor, esperado = _comparable(datos[filtro.field_path]), _comparable(filtro.value)
+            try:
+                if not _OPERADORES[filtro.op_string](valor, esperado):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def stream(self):
+        self._db._viaje()
+        with self._db._lock:
+            instantaneas = [
+                Instantanea(Documento(self._db, ruta), copy.deepcopy(datos))
+                for ruta, datos in self._db._docs.items()
+                if ruta.split("/")[-2] == self._coleccion and self._cumple(datos)
+            ]
+        return instantaneas[:self._limite] if self._limite is not None else instantaneas
+
+
+class Lote:
+    def __init__(self, db):
+        self._db = db
+        self._operaciones = []
+
+    def set(self, referencia, datos: dict, merge: bool = False):
+        self._operaciones.append(("set", referencia, datos, merge))
+
+    def update(self, referencia, datos: dict):
+        self._operaciones.append(("update", referencia, datos, None))
+
+    def create(self, referencia, datos: dict):
+        self._operaciones.append(("create", referencia, datos, None))
+
+    def delete(self, referencia):
+        self._operaciones.append(("delete", referencia, None, None))
+
+    def _aplicar_operaciones(self):
+        # Todo o nada, como un commit real
+        respaldo = copy.deepcopy(self._db._docs)
+        try:
+            for operacion, referencia, datos, merge in self._operaciones:
+                if operacion == "set":
+                    referencia._set(datos, merge)
+                elif operacion == "update":
+                    referencia._update(datos)
+                elif operacion == "create":
+                    referencia._create(datos)
+                else:
+                    referencia._delete()
+        except Exception:
+            self._db._docs = respaldo
+            raise
+        finally:
+            self._operaciones = []
+
+    def commit(self):
+        self._db._viaje()
+        with self._db._lock:
+            self._aplicar_operaciones()
+        return []
+
+
+class Transaccion(Lote):
+    pass
+
+
+def transactional(funcion):
+    # Reemplazo de firestore.transactional: serializa la transacción completa
+    def envoltura(transaccion, *args, **kwargs):
+        db = transaccion._db
+        db._viaje()
+        with db._lock:
+            resultado = funcion(transaccion, *args, **kwargs)
+            transaccion._aplicar_operaciones()
+        return resultado
+    return envoltura
+
+
+class _Suscripcion:
+    def __init__(self, db, ruta: str, callback):
+        self._db = db
+        self._ruta = ruta
+        self._callback = callback
+
+    def unsubscribe(self):
+        with self._db._lock:
+            oyentes = self._db._oyentes.get(self._ruta, [])
+            if self._callback in oyentes:
+                oyentes.remove(self._callback)
+
+
+class FirestoreMemoria:
+    def __init__(self, latencia: float = 0.0, tasa_fallos: float = 0.0):
+        self.latencia = latencia
+        self.tasa_fallos = tasa_fallos
+        self.viajes = 0
+        self._docs = {}
+        self._oyentes = {}
+        self._lock = threading.RLock()
+
+    def _viaje(self):
+        self.viajes += 1
+        if self.latencia:
+            time.sleep(self.latencia)
+        if self.tasa_fallos and random.random() < self.tasa_fallos:
+            raise ServiceUnavailable("Fallo inyectado por el benchmark")
+
+    def sembrar(self, ruta: str, datos: dict):
+        # Carga inicial: sin latencia ni fallos inyectados
+        with self._lock:
+            self._docs[ruta] = copy.deepcopy(datos)
+
+    def collection(self, nombre: str):
+        return Coleccion(self, nombre)
+
+    def document(self, ruta: str):
+        return Documento(self, ruta)
+
+    def collection_group(self, nombre: str):
+        return Consulta(self, nombre)
+
+    def batch(self):
+        return Lote(self)
+
+    def get_all(self, referencias, **kwargs):
+        # Una lectura de varios documentos cuenta como un solo viaje
+        self._viaje()
+        with self._lock:
+            return [
+                Instantanea(referencia, copy.deepcopy(self._docs.get(referencia.path)))
+                for referencia in referencias
+            ]
+
+    def transaction(self, **kwargs):
+        return Transaccion(self)
+
+    def _escuchar(self, referencia, callback):
+        with self._lock:
+            self._oyentes.setdefault(referencia.path, []).append(callback)
+            instantanea = Instantanea(referencia, copy.deepcopy(self._docs.get(referencia.path)))
+        callback([instantanea], [], None)
+        return _Suscripcion(self, referencia.path, callback)
+
+    def _notificar(self, referencia):
+        # Se llama con el lock tomado; los callbacks reales corren en otro hilo
+        oyentes = list(self._oyentes.get(referencia.path, []))
+        if not oyentes:
+            return
+        instantanea = Instantanea(referencia, copy.deepcopy(self._docs.get(referencia.path)))
+        for callback in oyentes:
+            threading.Thread(target=callback, args=([instantanea], [], None), daemon=True).start()
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import uuid
+
+from aiohttp import web
+
+# =========================
+# OpenAI y PayPal falsos para el benchmark
+# =========================
+# Un servidor aiohttp local que responde las mismas rutas que usa la app:
+# - OpenAI: POST /v1/chat/completions (normal y stream SSE)
+# - PayPal: /v1/oauth2/token, /v2/checkout/orders/{id}/capture y
+#   /v1/notifications/verify-webhook-signature
+# Así se ejercitan los clientes reales (sesión aiohttp, pool, timeouts).
+# Corre en su propio hilo y event loop para no competir con la app medida.
+# Cada servicio tiene su latencia (con ±20 % de variación) y una tasa de
+# fallos que responde 500.
+
+PREGUNTAS = {
+    "preguntas": [
+        {
+            "pregunta": f"¿Pregunta de prueba número {i}?",
+            "opciones": ["Opción A", "Opción B", "Opción C", "Opción D"],
+            "respuesta_correcta": "Opción A"
+        }
+        for i in range(1, 6)
+    ]
+}
+
+CLASIFICACION = { "clasificadas": { "Historia": { "Edad Moderna": ["Revolución Francesa", "Ilustración"] } } }
+
+
+def _tokens_aproximados(texto: str) -> int:
+    return max(1, len(texto) // 4)
+
+
+class ServiciosFalsos:
+    def __init__(self, latencia_openai: float = 0.5, fallos_openai: float = 0.0,
+                 latencia_paypal: float = 0.2, fallos_paypal: float = 0.0):
+        self.latencia_openai = latencia_openai
+        self.fallos_openai = fallos_openai
+        self.latencia_paypal = latencia_paypal
+        self.fallos_paypal = fallos_paypal
+        self.llamadas = { "openai": 0, "paypal": 0 }
+        self.url = None
+        self._runner = None
+        self._loop = None
+        self._hilo = None
+
+    async def _esperar(self, latencia: float):
+        if latencia:
+            await asyncio.sleep(latencia * random.uniform(0.8, 1.2))
+
+    def _falla(self, tasa: float) -> bool:
+        return bool(tasa) and random.random() < tasa
+
+    # ---- OpenAI ----
+
+    def _contenido_openai(self, mensajes: list) -> str:
+        sistema = mensajes[0]["content"] if mensajes else ""
+        usuario = mensajes[-1]["content"] if mensajes else ""
+
+        if "JSON puro" in sistema:
+            return json.dumps(PREGUNTAS, ensure_ascii=False)
+        if "varios conjuntos" in usuario:
+            total = len(re.findall(r"^\[\d+\]", usuario, re.M))
+            return json.dumps({ "resultados": { str(i): CLASIFICACION for i in range(total) } }, ensure_ascii=False)
+        return json.dumps(CLASIFICACION, ensure_ascii=False)
+
+    async def _chat(self, request: web.Request):
+        self.llamadas["openai"] += 1
+        cuerpo = await request.json()
+        await self._esperar(self.latencia_openai)
+
+        if self._falla(self.fallos_openai):
+            return web.json_response(
+                { "error": { "message": "Fallo inyectado por el benchmark", "type": "server_error" } },
+                status=500
+            )
+
+        contenido = self._contenido_openai(cuerpo.get("messages", []))
+        prompt = sum(_tokens_aproximados(m.get("content", "")) for m in cuerpo.get("messages", []))
+        respuesta = _tokens_aproximados(contenido)
+
+        # Con function calling el JSON va en los argumentos de la función
+        llamada = cuerpo.get("function_call")
+        funcion = llamada.get("name") if isinstance(llamada, dict) else None
+        if funcion:
+            mensaje = { "role": "assistant", "content": None, "function_call": { "name": funcion, "arguments": contenido } }
+        else:
+            mensaje = { "role": "assistant", "content": contenido }
+
+        if not cuerpo.get("stream"):
+            return web.json_response({
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "model": cuerpo.get("model"),
+                "choices": [{ "index": 0, "message": mensaje, "finish_reason": "function_call" if funcion else "stop" }],
+                "usage": { "prompt_tokens": prompt, "completion_tokens": respuesta, "total_tokens": prompt + respuesta }
+            })
+
+        stream = web.StreamResponse(headers={ "Content-Type": "text/event-stream" })
+        await stream.prepare(request)
+        for i in range(0, len(contenido), 16):
+            pedazo = contenido[i:i + 16]
+            delta = { "function_call": { "arguments": pedazo } } if funcion else { "content": pedazo }
+            fragmento = { "choices": [{ "index": 0, "delta": delta }] }
+            await stream.write(f"data: {json.dumps(fragmento, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await stream.write(b"data: [DONE]\n\n")
+        await stream.write_eof()
+        return stream
+
+    # ---- PayPal ----
+
+    async def _paypal(self, request: web.Request):
+        self.llamadas["paypal"] += 1
+        await self._esperar(self.latencia_paypal)
+        if self._falla(self.fallos_paypal):
+            return web.json_response({ "name": "INTERNAL_SERVER_ERROR" }, status=500)
+        return None
+
+    async def _token(self, request: web.Request):
+        return await self._paypal(request) or web.json_response({
+            "access_token": f"A21-{uuid.uuid4().hex}",
+            "token_type": "Bearer",
+            "expires_in": 32400
+        })
+
+    async def _capturar(self, request: web.Request):
+        # El id de la orden lleva el uid y el monto: "{uid}:{monto}:{cualquier cosa}"
+        orden_id = request.match_info["orden_id"]
+        uid, monto = (orden_id.split(":") + ["", "1.00"])[:2]
+        return await self._paypal(request) or web.json_response({
+            "id": orden_id,
+            "status": "COMPLETED",
+            "purchase_units": [{
+                "payments": { "captures": [{ "amount": { "value": monto, "currency_code": "USD" }, "custom_id": uid }] }
+            }]
+        })
+
+    async def _verificar(self, request: web.Request):
+        return await self._paypal(request) or web.json_response({ "verification_status": "SUCCESS" })
+
+    # ---- Servidor ----
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/oauth2/token", self._token)
+        app.router.add_post("/v2/checkout/orders/{orden_id}/capture", self._capturar)
+        app.router.add_post("/v1/notifications/verify-webhook-signature", self._verificar)
+        return app
+
+    async def _iniciar(self):
+        self._runner = web.AppRunner(self._app(), access_log=None)
+        await self._runner.setup()
+        sitio = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await sitio.start()
+        puerto = sitio._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{puerto}"
+
+    def _correr(self, listo: threading.Event):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._iniciar())
+        listo.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def iniciar(self) -> str:
+        listo = threading.Event()
+        self._hilo = threading.Thread(target=self._correr, args=(listo,), daemon=True)
+        self._hilo.start()
+        listo.wait()
+        return self.url
+
+    def detener(self):
+        if self._hilo is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._hilo.join()
+            self._hilo = None
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# =========================
+# Caché de resultados de GenerarPreguntas
+# =========================
+# Dos niveles: un LRU en memoria y un SQLite local con expiración (TTL) y
+# límite de entradas. La clave es un hash del texto normalizado junto con la
+# versión del prompt y el modelo, así que cambiar el prompt invalida la caché.
+#
+# obtener() y guardar() tocan SQLite: desde el event loop se llaman en un
+# hilo. obtener_en_memoria() solo mira el LRU y se puede llamar directo.
+# El LRU y SQLite tienen locks separados: una escritura lenta en disco no
+# frena las consultas en memoria, que toman solo el suyo.
+
+CACHE_MAX_MEMORIA = int(os.getenv("CACHE_MAX_MEMORIA", "512"))
+CACHE_MAX_DISCO = int(os.getenv("CACHE_MAX_DISCO", "20000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_RUTA = os.getenv("CACHE_RUTA", "cache_preguntas.db")
+
+
+def normalizar_texto(texto: str) -> str:
+    return " ".join(texto.split())
+
+
+def clave_cache(texto: str, version_prompt: str, modelo: str) -> str:
+    contenido = f"{version_prompt}\x00{modelo}\x00{normalizar_texto(texto)}"
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+class CacheResultados:
+    def __init__(self, ruta: str, max_memoria: int, max_disco: int, ttl: float):
+        self.ruta = ruta
+        self.max_memoria = max_memoria
+        self.max_disco = max_disco
+        self.ttl = ttl
+        self._memoria = OrderedDict()
+        # El LRU y los contadores; nunca se toma mientras se espera a SQLite
+        self._lock_memoria = threading.Lock()
+        self._lock_disco = threading.Lock()
+        self._conexion = None
+        self._escrituras = 0
+        self.aciertos_memoria = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+
+    def _db(self):
+        if self._conexion is None:
+            self._conexion = sqlite3.connect(self.ruta, check_same_thread=False)
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute("PRAGMA synchronous=NORMAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS resultados ("
+                " clave TEXT PRIMARY KEY,"
+                " valor TEXT NOT NULL,"
+                " creado REAL NOT NULL,"
+                " usado REAL NOT NULL)"
+            )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS idx_resultados_usado ON resultados (usado)")
+        return self._conexion
+
+    def _guardar_memoria(self, clave: str, valor: dict, creado: float):
+        with self._lock_memoria:
+            self._memoria[clave] = (valor, creado)
+            self._memoria.move_to_end(clave)
+            while len(self._memoria) > self.max_memoria:
+                self._memoria.popitem(last=False)
+
+    def _buscar_en_memoria(self, clave: str, ahora: float):
+        with self._lock_memoria:
+            entrada = self._memoria.get(clave)
+            if entrada is None:
+                return None
+            valor, creado = entrada
+            if ahora - creado > self.ttl:
+                del self._memoria[clave]
+                return None
+            self._memoria.move_to_end(clave)
+            self.aciertos_memoria += 1
+            return dict(valor)
+
+    def obtener_en_memoria(self, clave: str):
+        # Sin SQLite. Un fallo aquí no se cuenta: lo cuenta obtener() después.
+        return self._buscar_en_memoria(clave, time.time())
+
+    def obtener(self, clave: str):
+        ahora = time.time()
+        valor = self._buscar_en_memoria(clave, ahora)
+        if valor is not None:
+            return valor
+
+        with self._lock_disco:
+            db = self._db()
+            fila = db.execute("SELECT valor, creado FROM resultados WHERE clave = ?", (clave,)).fetchone()
+            if fila is not None and ahora - fila[1] <= self.ttl:
+                valor = json.loads(fila[0])
+                db.execute("UPDATE resultados SET usado = ? WHERE clave = ?", (ahora, clave))
+                db.commit()
+            elif fila is not None:
+                db.execute("DELETE FROM resultados WHERE clave = ?", (clave,))
+                db.commit()
+
+        if valor is not None:
+            self._guardar_memoria(clave, valor, fila[1])
+            with self._lock_memoria:
+                self.aciertos_disco += 1
+            return dict(valor)
+
+        with self._lock_memoria:
+            self.fallos += 1
+        return None
+
+    def guardar(self, clave: str, valor: dict):
+        ahora = time.time()
+        self._guardar_memoria(clave, valor, ahora)
+
+        with self._lock_disco:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO resultados (clave, valor, creado, usado) VALUES (?, ?, ?, ?)",
+                (clave, json.dumps(valor, ensure_ascii=False), ahora, ahora),
+            )
+            self._escrituras += 1
+            # El desalojo recorre la tabla, así que no se hace en cada escritura
+            if self._escrituras % 64 == 1:
+                self._desalojar(db, ahora)
+            db.commit()
+
+    def _desalojar(self, db, ahora: float):
+        db.execute("DELETE FROM resultados WHERE creado < ?", (ahora - self.ttl,))
+        total = db.execute("SELECT COUNT(*) FROM resultados").fetchone()[0]
+        if total > self.max_disco:
+            db.execute(
+                "DELETE FROM resultados WHERE clave IN ("
+                " SELECT clave FROM resultados ORDER BY usado ASC LIMIT ?)",
+                (total - self.max_disco,),
+            )
+
+    def estadisticas(self) -> dict:
+        with self._lock_memoria:
+            consultas = self.aciertos_memoria + self.aciertos_disco + self.fallos
+            return {
+                "aciertos_memoria": self.aciertos_memoria,
+                "aciertos_disco": self.aciertos_disco,
+                "fallos": self.fallos,
+                "tasa_aciertos": (self.aciertos_memoria + self.aciertos_disco) / consultas if consultas else 0.0,
+                "entradas_memoria": len(self._memoria),
+            }
+
+
+cache_preguntas = CacheResultados(
+    ruta=CACHE_RUTA,
+    max_memoria=CACHE_MAX_MEMORIA,
+    max_disco=CACHE_MAX_DISCO,
+    ttl=CACHE_TTL,
+)
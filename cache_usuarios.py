@@ -0,0 +1,318 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metricas import medir, registro
+
+# =========================
+# Caché de documentos de usuario
+# =========================
+# Guarda en memoria si cada usuario existe y su saldo, para rechazar antes de
+# tocar Firestore las solicitudes de usuarios que no existen o que no
+# alcanzan a pagar. La reserva en el libro de tokens sigue siendo la que
+# decide; la caché solo adelanta el rechazo.
+#
+# - consultar(uid) solo mira la memoria. Si el usuario no está (o su entrada
+#   ya no vale) no bloquea: quien llama sigue como antes y pide la carga en
+#   segundo plano con pedir_carga()/cargar(). Una carga por uid a la vez.
+# - El libro de tokens ya lee el documento en cada débito: lo que leyó lo
+#   anota aquí, así que una reserva no necesita otra lectura para llenar la
+#   caché. Los créditos (Increment) solo invalidan.
+# - Los CACHE_USUARIOS_MAX_OYENTES usuarios usados más recientemente tienen
+#   un on_snapshot de Firestore: sus cambios llegan solos y la entrada no
+#   vence. Las demás vencen a los CACHE_USUARIOS_TTL segundos.
+# - Máximo CACHE_USUARIOS_MAX usuarios; se van los usados hace más tiempo.
+# - De cada documento solo se guarda el saldo: nada de palabras_clave.
+
+CACHE_USUARIOS_MAX = int(os.getenv("CACHE_USUARIOS_MAX", "10000"))
+CACHE_USUARIOS_TTL = float(os.getenv("CACHE_USUARIOS_TTL", "60"))
+CACHE_USUARIOS_MAX_OYENTES = int(os.getenv("CACHE_USUARIOS_MAX_OYENTES", "200"))
+
+antiguedad_aciertos = registro.histograma(
+    "cache_usuarios_antiguedad_segundos",
+    "Segundos desde que se confirmó el dato servido por la caché de usuarios (0 con oyente)"
+)
+desfase_oyentes = registro.histograma(
+    "cache_usuarios_desfase_oyente_segundos",
+    "Segundos entre la lectura de Firestore y la llegada de la instantánea al oyente"
+)
+
+
+class EntradaUsuario:
+    __slots__ = ("datos", "confirmado", "valida", "version", "oyente", "suscribiendo")
+
+    def __init__(self):
+        # None si el usuario no existe
+        self.datos = None
+        self.confirmado = 0.0
+        self.valida = False
+        # Sube con cada invalidación: una lectura que empezó antes no deja la entrada válida
+        self.version = 0
+        self.oyente = None
+        # on_snapshot en curso: nadie más abre otro para este uid
+        self.suscribiendo = False
+
+
+def saldo(datos: dict) -> int:
+    tokens = (datos or {}).get("tokens", 0)
+    return tokens if isinstance(tokens, int) else 0
+
+
+def resumir(datos):
+    # Lo único que se guarda del documento del usuario
+    return None if datos is None else { "tokens": saldo(datos) }
+
+
+class CacheUsuarios:
+    def __init__(self, db, max_usuarios: int = CACHE_USUARIOS_MAX, ttl: float = CACHE_USUARIOS_TTL, max_oyentes: int = CACHE_USUARIOS_MAX_OYENTES):
+        self.db = db
+        self.max_usuarios = max_usuarios
+        self.ttl = ttl
+        self.max_oyentes = max_oyentes
+        self._entradas = OrderedDict()
+        # Oyentes abiertos más los que se están abriendo
+        self._oyentes = 0
+        self._cargando = set()
+        self._detenida = False
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.lecturas = 0
+        self.anotadas = 0
+        self.invalidaciones = 0
+        self.instantaneas = 0
+        # Lecturas que encontraron distinto el dato que la caché tenía guardado
+        self.desactualizadas = 0
+
+    def _usuario(self, uid: str):
+        return self.db.collection("usuarios").document(uid)
+
+    def _vigente(self, entrada: EntradaUsuario, ahora: float) -> bool:
+        if not entrada.valida:
+            return False
+        return entrada.oyente is not None or ahora - entrada.confirmado < self.ttl
+
+    def _reservar_entrada(self, uid: str) -> EntradaUsuario:
+        # Con el lock tomado
+        entrada = self._entradas.get(uid)
+        if entrada is None:
+            entrada = self._entradas[uid] = EntradaUsuario()
+        self._entradas.move_to_end(uid)
+        return entrada
+
+    # ---- Lecturas ----
+
+    def consultar(self, uid: str):
+        # (encontrado, datos). Sin viajes a Firestore; datos es None si el usuario no existe.
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(uid)
+            if entrada is None or not self._vigente(entrada, ahora):
+                self.fallos += 1
+                return False, None
+            self._entradas.move_to_end(uid)
+            self.aciertos += 1
+            datos = entrada.datos
+            antiguedad = 0.0 if entrada.oyente is not None else ahora - entrada.confirmado
+        antiguedad_aciertos.observar(antiguedad)
+        return True, datos
+
+    def obtener(self, uid: str):
+        # Lectura completa (bloqueante): memoria si está vigente, si no Firestore
+        with self._lock:
+            entrada = self._entradas.get(uid)
+            if entrada is not None and self._vigente(entrada, time.monotonic()):
+                self._entradas.move_to_end(uid)
+                return entrada.datos
+            entrada = self._reservar_entrada(uid)
+            version = entrada.version
+
+        with medir("firestore_usuario"):
+            documento = self._usuario(uid).get()
+        self.lecturas += 1
+        datos = resumir(documento.to_dict() if documento.exists else None)
+
+        with self._lock:
+            if entrada.confirmado and (entrada.datos is None, saldo(entrada.datos)) != (datos is None, saldo(datos)):
+                self.desactualizadas += 1
+            if entrada.version == version and self._entradas.get(uid) is entrada:
+                entrada.datos = datos
+                entrada.confirmado = time.monotonic()
+                entrada.valida = True
+        return datos
+
+    def pedir_carga(self, uid: str) -> bool:
+        # True si quien llama debe lanzar cargar(uid); False si ya hay una en curso
+        with self._lock:
+            if self._detenida or uid in self._cargando:
+                return False
+            self._cargando.add(uid)
+            return True
+
+    def cargar(self, uid: str, leer: bool = True):
+        # Para correr en segundo plano después de pedir_carga(). Con leer=False
+        # solo se abre el oyente: el dato llegará con él o con la próxima reserva.
+        try:
+            self.liberar_oyente()
+            with self._lock:
+                entrada = self._reservar_entrada(uid)
+            self._escuchar(uid, entrada)
+            if leer:
+                self.obtener(uid)
+            self.desalojar()
+        except Exception as e:
+            print(f"⚠️ No se pudo cargar el usuario {uid} en la caché:", str(e))
+        finally:
+            with self._lock:
+                self._cargando.discard(uid)
+
+    # ---- Oyentes ----
+
+    def _escuchar(self, uid: str, entrada: EntradaUsuario):
+        with self._lock:
+            if self._detenida or entrada.oyente is not None or entrada.suscribiendo or self._oyentes >= self.max_oyentes:
+                return
+            # Se marca antes de suscribirse: otra carga del mismo uid no abre un segundo oyente
+            entrada.suscribiendo = True
+            self._oyentes += 1
+        try:
+            oyente = self._usuario(uid).on_snapshot(
+                lambda documentos, cambios, leido_en: self._al_cambiar(uid, entrada, documentos, leido_en)
+            )
+        except Exception as e:
+            with self._lock:
+                entrada.suscribiendo = False
+                self._oyentes -= 1
+            print(f"⚠️ No se pudo escuchar al usuario {uid}:", str(e))
+            return
+
+        cerrar = False
+        with self._lock:
+            entrada.suscribiendo = False
+            if not self._detenida and self._entradas.get(uid) is entrada:
+                entrada.oyente = oyente
+            else:
+                # Se desalojó o se detuvo la caché mientras se suscribía
+                self._oyentes -= 1
+                cerrar = True
+        if cerrar:
+            self._cerrar_oyentes([oyente])
+
+    def _al_cambiar(self, uid: str, entrada: EntradaUsuario, documentos: list, leido_en):
+        # Corre en el hilo de Firestore
+        if leido_en is not None:
+            desfase_oyentes.observar(max(0.0, time.time() - leido_en.timestamp()))
+        documento = documentos[0] if documentos else None
+        datos = resumir(documento.to_dict() if documento is not None else None)
+        with self._lock:
+            self.instantaneas += 1
+            if self._entradas.get(uid) is not entrada:
+                return
+            entrada.datos = datos
+            entrada.confirmado = time.monotonic()
+            entrada.valida = True
+
+    # ---- Escrituras propias (libro de tokens) ----
+
+    def _instantanea_posterior(self, entrada: EntradaUsuario, desde: float) -> bool:
+        # El oyente ya trajo algo posterior al inicio de la escritura: trae la
+        # escritura o la siguiente instantánea la traerá
+        return desde is not None and entrada.oyente is not None and entrada.valida and entrada.confirmado >= desde
+
+    def anotar(self, uid: str, datos, desde: float = None):
+        # Lo que el libro leyó (y escribió) en una transacción; datos None si no existe
+        oyentes = []
+        with self._lock:
+            if self._detenida:
+                return
+            entrada = self._reservar_entrada(uid)
+            if self._instantanea_posterior(entrada, desde):
+                return
+            entrada.datos = resumir(datos)
+            entrada.confirmado = time.monotonic()
+            entrada.valida = True
+            entrada.version += 1
+            self.anotadas += 1
+            oyentes = self._desalojar_con_lock()
+        self._cerrar_oyentes(oyentes)
+
+    def invalidar(self, uid: str, desde: float = None):
+        # desde: time.monotonic() de cuando empezó la escritura
+        with self._lock:
+            entrada = self._entradas.get(uid)
+            if entrada is None or self._instantanea_posterior(entrada, desde):
+                return
+            entrada.valida = False
+            entrada.version += 1
+            self.invalidaciones += 1
+
+    # ---- Desalojo ----
+
+    def _desalojar_con_lock(self) -> list:
+        # Devuelve los oyentes a cerrar (fuera del lock)
+        oyentes = []
+        while len(self._entradas) > self.max_usuarios:
+            _, entrada = self._entradas.popitem(last=False)
+            if entrada.oyente is not None:
+                oyentes.append(entrada.oyente)
+                entrada.oyente = None
+                self._oyentes -= 1
+        return oyentes
+
+    def desalojar(self):
+        # Quita las entradas de más y los oyentes de los usuarios menos activos
+        with self._lock:
+            oyentes = self._desalojar_con_lock()
+        self._cerrar_oyentes(oyentes)
+
+    def liberar_oyente(self):
+        # Si ya no quedan oyentes libres se le quita el suyo al usuario usado hace más tiempo
+        with self._lock:
+            if self._oyentes < self.max_oyentes:
+                return
+            for entrada in self._entradas.values():
+                if entrada.oyente is not None:
+                    oyente, entrada.oyente = entrada.oyente, None
+                    self._oyentes -= 1
+                    break
+            else:
+                return
+        self._cerrar_oyentes([oyente])
+
+    def _cerrar_oyentes(self, oyentes: list):
+        # Fuera del lock: unsubscribe puede esperar al hilo del oyente
+        for oyente in oyentes:
+            try:
+                oyente.unsubscribe()
+            except Exception as e:
+                print("⚠️ No se pudo cerrar un oyente de usuario:", str(e))
+
+    def detener(self):
+        # Los oyentes que todavía se están abriendo se cierran en _escuchar al terminar
+        with self._lock:
+            self._detenida = True
+            oyentes = []
+            for entrada in self._entradas.values():
+                if entrada.oyente is not None:
+                    oyentes.append(entrada.oyente)
+                    entrada.oyente = None
+                    self._oyentes -= 1
+                entrada.valida = False
+        self._cerrar_oyentes(oyentes)
+
+    def estadisticas(self) -> dict:
+        consultas = self.aciertos + self.fallos
+        return {
+            "usuarios": len(self._entradas),
+            "oyentes": self._oyentes,
+            "cargando": len(self._cargando),
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": self.aciertos / consultas if consultas else 0.0,
+            "lecturas": self.lecturas,
+            "anotadas": self.anotadas,
+            "invalidaciones": self.invalidaciones,
+            "instantaneas": self.instantaneas,
+            "desactualizadas": self.desactualizadas
+        }
@@ -0,0 +1,202 @@
+import asyncio
+import os
+
+from cliente_llm import cliente_llm
+from metricas import medir
+from plantillas_prompt import PLANTILLA_PALABRAS_CLAVE, PLANTILLA_PALABRAS_CLAVE_LOTE
+from salida_estructurada import contenido_respuesta, leer_clasificacion, leer_clasificacion_lote
+
+# =========================
+# Clasificación de palabras clave por lotes
+# =========================
+# Cuando un grupo entero termina un quiz llegan muchas solicitudes a
+# /clasificar-palabras-clave/ casi al mismo tiempo. El micro-lote las junta
+# durante una ventana corta (o hasta MAX_LOTE), hace una sola llamada a
+# gpt-4o con el contenido de todos y reparte el resultado por solicitud.
+# Si hay un índice local, lo que este ya sabe clasificar no llega a gpt-4o,
+# y lo que sí llega se aprende.
+#
+# Los pesos van al perfil de palabras (perfil_palabras.py). El campo
+# palabras_clave del documento del usuario (un solo WriteBatch por lote) se
+# sigue escribiendo mientras haya lectores que lo usen; con
+# PALABRAS_CLAVE_LEGADO=0 solo se escribe si no hay perfil.
+
+VENTANA_LOTE = float(os.getenv("CLASIFICACION_VENTANA_MS", "50")) / 1000
+MAX_LOTE = int(os.getenv("CLASIFICACION_MAX_LOTE", "16"))
+PALABRAS_CLAVE_LEGADO = os.getenv("PALABRAS_CLAVE_LEGADO", "1") == "1"
+
+
+def construir_actualizaciones(datos: dict) -> dict:
+    # Firestore { palabra: { peso: 1.0 } }
+    updates = {}
+    for materia, subramas in datos["clasificadas"].items():
+        for subrama, palabras in subramas.items():
+            for palabra in palabras:
+                ruta = f"palabras_clave.{materia}.{subrama}.{palabra}"
+                updates[ruta] = {"peso": 1.0}
+    return updates
+
+
+class _Solicitud:
+    def __init__(self, uid: str, contenido: list):
+        self.uid = uid
+        self.contenido = contenido
+        self.futuro = asyncio.get_running_loop().create_future()
+
+
+class MicroLoteClasificacion:
+    def __init__(self, db, ventana: float, max_lote: int, indice=None, perfil=None):
+        self.db = db
+        self.indice = indice
+        self.perfil = perfil
+        self.escribir_legado = PALABRAS_CLAVE_LEGADO or perfil is None
+        self.ventana = ventana
+        self.max_lote = max_lote
+        self._pendientes = []
+        self._temporizador = None
+        self._tareas = set()
+        self.llamadas_llm = 0
+        self.solicitudes = 0
+        self.resueltas_localmente = 0
+
+    async def clasificar(self, uid: str, contenido: list) -> dict:
+        solicitud = _Solicitud(uid, contenido)
+        self._pendientes.append(solicitud)
+
+        if len(self._pendientes) >= self.max_lote:
+            self._despachar()
+        elif self._temporizador is None:
+            self._temporizador = asyncio.get_running_loop().call_later(self.ventana, self._despachar)
+
+        return await solicitud.futuro
+
+    async def clasificar_varios(self, solicitudes: list) -> list:
+        # Lote explícito: no espera la ventana. Devuelve resultados o excepciones en el mismo orden.
+        pendientes = [_Solicitud(uid, contenido) for uid, contenido in solicitudes]
+        for i in range(0, len(pendientes), self.max_lote):
+            self._lanzar(pendientes[i:i + self.max_lote])
+        return await asyncio.gather(*(s.futuro for s in pendientes), return_exceptions=True)
+
+    def _despachar(self):
+        if self._temporizador is not None:
+            self._temporizador.cancel()
+            self._temporizador = None
+        lote, self._pendientes = self._pendientes, []
+        if lote:
+            self._lanzar(lote)
+
+    def _lanzar(self, lote: list):
+        tarea = asyncio.create_task(self._procesar(lote))
+        self._tareas.add(tarea)
+        tarea.add_done_callback(self._tareas.discard)
+
+    async def _llamar_llm(self, lote: list) -> list:
+        self.llamadas_llm += 1
+        self.solicitudes += len(lote)
+
+        if len(lote) == 1:
+            response = await cliente_llm.chat(
+                model="gpt-4o",
+                messages=PLANTILLA_PALABRAS_CLAVE.mensajes(str(lote[0].contenido)),
+                max_tokens=3000,
+                **PLANTILLA_PALABRAS_CLAVE.parametros()
+            )
+            return [leer_clasificacion(contenido_respuesta(response))]
+
+        bloques = "\n".join(f"[{i}] {s.contenido}" for i, s in enumerate(lote))
+        response = await cliente_llm.chat(
+            model="gpt-4o",
+            messages=PLANTILLA_PALABRAS_CLAVE_LOTE.mensajes(bloques),
+            max_tokens=min(4000, 500 + 250 * len(lote)),
+            **PLANTILLA_PALABRAS_CLAVE_LOTE.parametros()
+        )
+        return leer_clasificacion_lote(contenido_respuesta(response), len(lote))
+
+    def _escribir(self, clasificados: list) -> dict:
+        # Un solo WriteBatch para todo el lote. Si falla (p. ej. un uid inexistente)
+        # se reintenta usuario por usuario para aislar el error. Devuelve {indice: error}.
+        batch = self.db.batch()
+        for _, solicitud, updates in clasificados:
+            batch.update(self.db.collection("usuarios").document(solicitud.uid), updates)
+
+        try:
+            with medir("firestore_palabras_clave"):
+                batch.commit()
+            return {}
+        except Exception:
+            errores = {}
+            for i, solicitud, updates in clasificados:
+                try:
+                    self.db.collection("usuarios").document(solicitud.uid).update(updates)
+                except Exception as e:
+                    errores[i] = e
+            return errores
+
+    async def _resolver(self, lote: list) -> list:
+        resultados = [None] * len(lote)
+        faltantes = list(range(len(lote)))
+
+        if self.indice is not None:
+            faltantes = []
+            for i, solicitud in enumerate(lote):
+                resultados[i] = self.indice.clasificar(solicitud.contenido)
+                if resultados[i] is None:
+                    faltantes.append(i)
+            self.resueltas_localmente += len(lote) - len(faltantes)
+
+        if faltantes:
+            with medir("clasificacion_palabras"):
+                datos_llm = await self._llamar_llm([lote[i] for i in faltantes])
+            for i, datos in zip(faltantes, datos_llm):
+                resultados[i] = datos
+                if self.indice is not None and isinstance(datos, dict):
+                    self.indice.aprender(lote[i].contenido, datos)
+
+        return resultados
+
+    async def _procesar(self, lote: list):
+        try:
+            resultados = await self._resolver(lote)
+        except Exception as e:
+            for solicitud in lote:
+                if not solicitud.futuro.done():
+                    solicitud.futuro.set_exception(e)
+            return
+
+        clasificados = []
+        errores = {}
+        for i, (solicitud, datos) in enumerate(zip(lote, resultados)):
+            try:
+                if not isinstance(datos, dict):
+                    raise ValueError("La IA no devolvió clasificación para este contenido.")
+                if self.perfil is not None:
+                    self.perfil.registrar(solicitud.uid, datos)
+                if self.escribir_legado:
+                    updates = construir_actualizaciones(datos)
+                    if updates:
+                        clasificados.append((i, solicitud, updates))
+            except Exception as e:
+                errores[i] = e
+
+        if clasificados:
+            try:
+                errores.update(await asyncio.to_thread(self._escribir, clasificados))
+            except Exception as e:
+                for i, _, _ in clasificados:
+                    errores[i] = e
+
+        for i, (solicitud, datos) in enumerate(zip(lote, resultados)):
+            if solicitud.futuro.done():
+                continue
+            if i in errores:
+                solicitud.futuro.set_exception(errores[i])
+            else:
+                solicitud.futuro.set_result(datos)
+
+    def estadisticas(self) -> dict:
+        return {
+            "solicitudes": self.solicitudes,
+            "llamadas_llm": self.llamadas_llm,
+            "resueltas_localmente": self.resueltas_localmente,
+            "solicitudes_por_llamada": self.solicitudes / self.llamadas_llm if self.llamadas_llm else 0.0
+        }
@@ -0,0 +1,92 @@
+import asyncio
+import os
+
+import aiohttp
+import openai
+
+from metricas import medir, registrar_uso_openai
+
+# =========================
+# Cliente asíncrono de OpenAI
+# =========================
+# Las llamadas a openai.ChatCompletion.create bloquean el event loop de uvicorn.
+# Este cliente usa ChatCompletion.acreate sobre una sesión aiohttp compartida
+# (pool de conexiones keep-alive) y limita cuántas llamadas hay en vuelo.
+
+LLM_MAX_CONCURRENCIA = int(os.getenv("LLM_MAX_CONCURRENCIA", "16"))
+LLM_MAX_CONEXIONES = int(os.getenv("LLM_MAX_CONEXIONES", "32"))
+LLM_KEEPALIVE = float(os.getenv("LLM_KEEPALIVE", "30"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))
+LLM_TIMEOUT_CONEXION = float(os.getenv("LLM_TIMEOUT_CONEXION", "10"))
+
+
+class ClienteLLM:
+    def __init__(self, max_concurrencia: int, max_conexiones: int, keepalive: float, timeout: float, timeout_conexion: float):
+        self.max_concurrencia = max_concurrencia
+        self.max_conexiones = max_conexiones
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.timeout_conexion = timeout_conexion
+        self._sesion = None
+        self._semaforo = asyncio.Semaphore(max_concurrencia)
+
+    async def iniciar(self):
+        if self._sesion is None or self._sesion.closed:
+            conector = aiohttp.TCPConnector(
+                limit=self.max_conexiones,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=300,
+            )
+            self._sesion = aiohttp.ClientSession(
+                connector=conector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout, connect=self.timeout_conexion),
+            )
+        return self._sesion
+
+    async def cerrar(self):
+        if self._sesion is not None and not self._sesion.closed:
+            await self._sesion.close()
+        self._sesion = None
+
+    async def chat(self, **parametros) -> dict:
+        sesion = await self.iniciar()
+
+        async with self._semaforo:
+            # aiosession es un ContextVar: se fija dentro de la tarea actual
+            openai.aiosession.set(sesion)
+            with medir("openai"):
+                respuesta = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(request_timeout=self.timeout, **parametros),
+                    timeout=self.timeout,
+                )
+            registrar_uso_openai(parametros.get("model", ""), respuesta.get("usage"))
+            return respuesta
+
+    async def chat_stream(self, **parametros):
+        # Devuelve el texto de la respuesta fragmento a fragmento (o los
+        # argumentos de la función, si se pidió function calling). El cupo de
+        # concurrencia se mantiene tomado mientras dure el stream.
+        sesion = await self.iniciar()
+
+        async with self._semaforo:
+            openai.aiosession.set(sesion)
+            with medir("openai_stream"):
+                respuesta = await asyncio.wait_for(
+                    openai.ChatCompletion.acreate(request_timeout=self.timeout, stream=True, **parametros),
+                    timeout=self.timeout,
+                )
+                async for fragmento in respuesta:
+                    opciones = fragmento.get("choices") or [{}]
+                    delta = opciones[0].get("delta", {})
+                    contenido = delta.get("content") or delta.get("function_call", {}).get("arguments")
+                    if contenido:
+                        yield contenido
+
+
+cliente_llm = ClienteLLM(
+    max_concurrencia=LLM_MAX_CONCURRENCIA,
+    max_conexiones=LLM_MAX_CONEXIONES,
+    keepalive=LLM_KEEPALIVE,
+    timeout=LLM_TIMEOUT,
+    timeout_conexion=LLM_TIMEOUT_CONEXION,
+)
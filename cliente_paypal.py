@@ -0,0 +1,130 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+
+from metricas import medir
+
+# =========================
+# Cliente de la API REST de PayPal
+# =========================
+# Mantiene una sesión aiohttp compartida (pool keep-alive) y el access token
+# de OAuth en memoria hasta poco antes de que venza. Si varias solicitudes
+# necesitan renovarlo a la vez, solo una lo pide (single-flight) y las demás
+# esperan ese mismo resultado.
+
+PAYPAL_API_BASE = os.getenv("PAYPAL_API_BASE", "https://api-m.sandbox.paypal.com")
+# Sin valores por defecto: la app no arranca si faltan (ver iniciar)
+PAYPAL_CLIENT_ID = os.getenv("PAYPAL_CLIENT_ID")
+PAYPAL_CLIENT_SECRET = os.getenv("PAYPAL_CLIENT_SECRET")
+PAYPAL_WEBHOOK_ID = os.getenv("PAYPAL_WEBHOOK_ID")
+PAYPAL_TIMEOUT = float(os.getenv("PAYPAL_TIMEOUT", "20"))
+PAYPAL_MAX_CONEXIONES = int(os.getenv("PAYPAL_MAX_CONEXIONES", "20"))
+# Se renueva el token este número de segundos antes de que venza
+MARGEN_TOKEN = 60
+
+CABECERAS_FIRMA = {
+    "auth_algo": "paypal-auth-algo",
+    "cert_url": "paypal-cert-url",
+    "transmission_id": "paypal-transmission-id",
+    "transmission_sig": "paypal-transmission-sig",
+    "transmission_time": "paypal-transmission-time",
+}
+
+
+class ClientePayPal:
+    def __init__(self, api_base: str, client_id: str, client_secret: str, timeout: float, max_conexiones: int):
+        self.api_base = api_base
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = timeout
+        self.max_conexiones = max_conexiones
+        self._sesion = None
+        self._token = None
+        self._vence = 0.0
+        self._lock_token = asyncio.Lock()
+
+    async def iniciar(self):
+        if not self.client_id or not self.client_secret:
+            raise RuntimeError("Faltan PAYPAL_CLIENT_ID y/o PAYPAL_CLIENT_SECRET en el entorno.")
+        if self._sesion is None or self._sesion.closed:
+            self._sesion = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_conexiones, keepalive_timeout=30),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._sesion
+
+    async def cerrar(self):
+        if self._sesion is not None and not self._sesion.closed:
+            await self._sesion.close()
+        self._sesion = None
+
+    def _token_vigente(self) -> bool:
+        return self._token is not None and time.monotonic() < self._vence - MARGEN_TOKEN
+
+    async def obtener_token(self) -> str:
+        if self._token_vigente():
+            return self._token
+
+        async with self._lock_token:
+            # Otra tarea pudo renovarlo mientras se esperaba el lock
+            if self._token_vigente():
+                return self._token
+
+            sesion = await self.iniciar()
+            with medir("paypal_token"):
+                async with sesion.post(
+                    f"{self.api_base}/v1/oauth2/token",
+                    data={ "grant_type": "client_credentials" },
+                    auth=aiohttp.BasicAuth(self.client_id, self.client_secret),
+                ) as respuesta:
+                    respuesta.raise_for_status()
+                    datos = await respuesta.json()
+
+            self._token = datos["access_token"]
+            self._vence = time.monotonic() + float(datos.get("expires_in", 0))
+            return self._token
+
+    def invalidar_token(self):
+        self._token = None
+        self._vence = 0.0
+
+    async def _post_autenticado(self, ruta: str, cuerpo: dict = None) -> dict:
+        sesion = await self.iniciar()
+
+        for intento in range(2):
+            token = await self.obtener_token()
+            async with sesion.post(
+                f"{self.api_base}{ruta}",
+                json=cuerpo,
+                headers={ "Authorization": f"Bearer {token}" },
+            ) as respuesta:
+                # Token revocado antes de tiempo: se pide otro y se reintenta una vez
+                if respuesta.status == 401 and intento == 0:
+                    self.invalidar_token()
+                    continue
+                respuesta.raise_for_status()
+                return await respuesta.json()
+
+    async def capturar_orden(self, orden_id: str) -> dict:
+        with medir("paypal_captura"):
+            return await self._post_autenticado(f"/v2/checkout/orders/{orden_id}/capture", {})
+
+    async def verificar_webhook(self, cabeceras, evento: dict, webhook_id: str) -> bool:
+        cuerpo = { clave: cabeceras.get(cabecera) for clave, cabecera in CABECERAS_FIRMA.items() }
+        cuerpo["webhook_id"] = webhook_id
+        cuerpo["webhook_event"] = evento
+
+        with medir("paypal_verificacion"):
+            datos = await self._post_autenticado("/v1/notifications/verify-webhook-signature", cuerpo)
+        return datos.get("verification_status") == "SUCCESS"
+
+
+cliente_paypal = ClientePayPal(
+    api_base=PAYPAL_API_BASE,
+    client_id=PAYPAL_CLIENT_ID,
+    client_secret=PAYPAL_CLIENT_SECRET,
+    timeout=PAYPAL_TIMEOUT,
+    max_conexiones=PAYPAL_MAX_CONEXIONES,
+)
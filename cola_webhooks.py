@@ -0,0 +1,286 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from metricas import medir
+
+# =========================
+# Cola local de webhooks
+# =========================
+# Los webhooks de PayPal se guardan primero en un SQLite local (modo WAL) y se
+# responde 200 de inmediato. Un grupo de trabajadores vacía la cola:
+# - Deduplicación por clave (id del evento o de la transacción de PayPal).
+#   Si la clave de la cola no es confiable hasta procesar el evento (p. ej. antes
+#   de verificar la firma), el manejador deduplica otra vez con reclamar().
+# - Reintentos con espera exponencial y jitter.
+# - Tras MAX_INTENTOS, o con un ErrorPermanente, el evento pasa a la tabla
+#   eventos_muertos para revisarlo a mano.
+# Los eventos tomados tienen un plazo (PLAZO_PROCESO); si el proceso muere a
+# mitad, otro trabajador los retoma al vencer el plazo.
+
+COLA_RUTA = os.getenv("COLA_WEBHOOKS_RUTA", "cola_webhooks.db")
+COLA_TRABAJADORES = int(os.getenv("COLA_WEBHOOKS_TRABAJADORES", "4"))
+COLA_MAX_INTENTOS = int(os.getenv("COLA_WEBHOOKS_MAX_INTENTOS", "8"))
+COLA_ESPERA_BASE = float(os.getenv("COLA_WEBHOOKS_ESPERA_BASE", "2"))
+COLA_ESPERA_MAX = float(os.getenv("COLA_WEBHOOKS_ESPERA_MAX", "300"))
+COLA_PLAZO_PROCESO = float(os.getenv("COLA_WEBHOOKS_PLAZO", "120"))
+# Los eventos ya procesados se guardan este tiempo para seguir deduplicando reintentos
+COLA_RETENCION_HECHOS = float(os.getenv("COLA_WEBHOOKS_RETENCION", str(30 * 24 * 3600)))
+INTERVALO_SONDEO = 1.0
+
+
+class ErrorPermanente(Exception):
+    # Reintentar no va a servir (usuario inexistente, datos inválidos...)
+    pass
+
+
+class ColaWebhooks:
+    def __init__(self, ruta: str, trabajadores: int, max_intentos: int, espera_base: float, espera_max: float, plazo_proceso: float):
+        self.ruta = ruta
+        self.trabajadores = trabajadores
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.espera_max = espera_max
+        self.plazo_proceso = plazo_proceso
+        self._manejadores = {}
+        self._conexion = None
+        self._lock = threading.Lock()
+        self._tareas = []
+        self._hay_eventos = None
+        self._detenida = False
+
+    def registrar(self, tipo: str, manejador):
+        # manejador(payload: dict): si es síncrono se ejecuta en un hilo; si es
+        # async, en el loop de los trabajadores
+        self._manejadores[tipo] = manejador
+
+    def _db(self):
+        if self._conexion is None:
+            conexion = sqlite3.connect(self.ruta, check_same_thread=False, isolation_level=None, timeout=30)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=FULL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS eventos ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " clave TEXT NOT NULL UNIQUE,"
+                " tipo TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " estado TEXT NOT NULL DEFAULT 'pendiente',"
+                " intentos INTEGER NOT NULL DEFAULT 0,"
+                " proximo_intento REAL NOT NULL,"
+                " bloqueado_hasta REAL,"
+                " ultimo_error TEXT,"
+                " creado REAL NOT NULL,"
+                " actualizado REAL NOT NULL)"
+            )
+            conexion.execute(
+                "CREATE INDEX IF NOT EXISTS idx_eventos_listos ON eventos (estado, proximo_intento)"
+            )
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS eventos_muertos ("
+                " id INTEGER PRIMARY KEY,"
+                " clave TEXT NOT NULL,"
+                " tipo TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " intentos INTEGER NOT NULL,"
+                " ultimo_error TEXT,"
+                " creado REAL NOT NULL,"
+                " muerto REAL NOT NULL)"
+            )
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS claves_reclamadas ("
+                " clave TEXT PRIMARY KEY,"
+                " dueno TEXT NOT NULL,"
+                " creado REAL NOT NULL)"
+            )
+            self._conexion = conexion
+        return self._conexion
+
+    # ---- Productores ----
+
+    def _encolar(self, tipo: str, clave: str, payload: dict) -> bool:
+        ahora = time.time()
+        with self._lock:
+            cursor = self._db().execute(
+                "INSERT OR IGNORE INTO eventos (clave, tipo, payload, proximo_intento, creado, actualizado)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (clave, tipo, json.dumps(payload, ensure_ascii=False), ahora, ahora, ahora),
+            )
+            return cursor.rowcount == 1
+
+    async def encolar(self, tipo: str, clave: str, payload: dict) -> bool:
+        # Devuelve False si la clave ya estaba en la cola (evento repetido)
+        nuevo = await asyncio.to_thread(self._encolar, tipo, clave, payload)
+        if nuevo and self._hay_eventos is not None:
+            self._hay_eventos.set()
+        return nuevo
+
+    # ---- Manejadores ----
+
+    def _reclamar(self, clave: str, dueno: str) -> bool:
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR IGNORE INTO claves_reclamadas (clave, dueno, creado) VALUES (?, ?, ?)",
+                (clave, dueno, time.time()),
+            )
+            fila = db.execute("SELECT dueno FROM claves_reclamadas WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] == dueno
+
+    async def reclamar(self, clave: str, dueno: str) -> bool:
+        # False si otro evento (con otra clave de cola, dueno) ya reclamó la clave.
+        # Los reintentos del mismo evento la vuelven a obtener.
+        return await asyncio.to_thread(self._reclamar, clave, dueno)
+
+    # ---- Trabajadores ----
+
+    def _tomar(self):
+        ahora = time.time()
+        tipos = list(self._manejadores)
+        if not tipos:
+            return None
+        marcadores = ",".join("?" for _ in tipos)
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                fila = db.execute(
+                    "SELECT id, clave, tipo, payload, intentos FROM eventos"
+                    f" WHERE tipo IN ({marcadores}) AND ("
+                    "  (estado = 'pendiente' AND proximo_intento <= ?)"
+                    "  OR (estado = 'procesando' AND bloqueado_hasta < ?))"
+                    " ORDER BY id LIMIT 1",
+                    (*tipos, ahora, ahora),
+                ).fetchone()
+                if fila is not None:
+                    db.execute(
+                        "UPDATE eventos SET estado = 'procesando', bloqueado_hasta = ?, actualizado = ? WHERE id = ?",
+                        (ahora + self.plazo_proceso, ahora, fila[0]),
+                    )
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return fila
+
+    def _marcar_hecho(self, evento_id: int):
+        with self._lock:
+            self._db().execute(
+                "UPDATE eventos SET estado = 'hecho', payload = '{}', bloqueado_hasta = NULL, actualizado = ? WHERE id = ?",
+                (time.time(), evento_id),
+            )
+
+    def _marcar_fallo(self, fila, error: str, permanente: bool):
+        evento_id, clave, tipo, payload, intentos = fila
+        intentos += 1
+        ahora = time.time()
+        with self._lock:
+            db = self._db()
+            if permanente or intentos >= self.max_intentos:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute(
+                    "INSERT OR REPLACE INTO eventos_muertos (id, clave, tipo, payload, intentos, ultimo_error, creado, muerto)"
+                    " SELECT id, clave, tipo, payload, ?, ?, creado, ? FROM eventos WHERE id = ?",
+                    (intentos, error, ahora, evento_id),
+                )
+                # Se conserva la fila como 'muerto' para seguir deduplicando reintentos de PayPal
+                db.execute(
+                    "UPDATE eventos SET estado = 'muerto', intentos = ?, ultimo_error = ?, bloqueado_hasta = NULL, actualizado = ? WHERE id = ?",
+                    (intentos, error, ahora, evento_id),
+                )
+                db.execute("COMMIT")
+                return True
+
+            espera = min(self.espera_max, self.espera_base * (2 ** (intentos - 1)))
+            espera *= random.uniform(0.5, 1.0)
+            db.execute(
+                "UPDATE eventos SET estado = 'pendiente', intentos = ?, ultimo_error = ?, proximo_intento = ?,"
+                " bloqueado_hasta = NULL, actualizado = ? WHERE id = ?",
+                (intentos, error, ahora + espera, ahora, evento_id),
+            )
+            return False
+
+    def _purgar(self):
+        limite = time.time() - COLA_RETENCION_HECHOS
+        with self._lock:
+            self._db().execute("DELETE FROM eventos WHERE estado IN ('hecho', 'muerto') AND actualizado < ?", (limite,))
+            self._db().execute("DELETE FROM claves_reclamadas WHERE creado < ?", (limite,))
+
+    async def _procesar(self, fila):
+        evento_id, clave, tipo, payload, intentos = fila
+        try:
+            manejador = self._manejadores[tipo]
+            with medir(f"webhook_{tipo}"):
+                if asyncio.iscoroutinefunction(manejador):
+                    await manejador(json.loads(payload))
+                else:
+                    await asyncio.to_thread(manejador, json.loads(payload))
+        except ErrorPermanente as e:
+            await asyncio.to_thread(self._marcar_fallo, fila, str(e), True)
+            print(f"❌ Webhook {clave} enviado a eventos_muertos:", str(e))
+        except Exception as e:
+            muerto = await asyncio.to_thread(self._marcar_fallo, fila, str(e), False)
+            if muerto:
+                print(f"❌ Webhook {clave} agotó sus reintentos:", str(e))
+            else:
+                print(f"⚠️ Webhook {clave} falló (intento {intentos + 1}), se reintentará:", str(e))
+        else:
+            await asyncio.to_thread(self._marcar_hecho, evento_id)
+
+    async def _trabajador(self):
+        while not self._detenida:
+            try:
+                fila = await asyncio.to_thread(self._tomar)
+            except Exception as e:
+                print("❌ Error leyendo la cola de webhooks:", str(e))
+                fila = None
+
+            if fila is not None:
+                await self._procesar(fila)
+                continue
+
+            self._hay_eventos.clear()
+            try:
+                await asyncio.wait_for(self._hay_eventos.wait(), timeout=INTERVALO_SONDEO)
+            except asyncio.TimeoutError:
+                pass
+
+    async def iniciar(self):
+        if self._tareas:
+            return
+        self._detenida = False
+        self._hay_eventos = asyncio.Event()
+        await asyncio.to_thread(self._purgar)
+        self._tareas = [asyncio.create_task(self._trabajador()) for _ in range(self.trabajadores)]
+
+    async def detener(self):
+        self._detenida = True
+        if self._hay_eventos is not None:
+            self._hay_eventos.set()
+        # Lo que esté a medias se retoma en el próximo arranque al vencer su plazo
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            db = self._db()
+            por_estado = dict(db.execute("SELECT estado, COUNT(*) FROM eventos GROUP BY estado").fetchall())
+            muertos = db.execute("SELECT COUNT(*) FROM eventos_muertos").fetchone()[0]
+        return { "por_estado": por_estado, "eventos_muertos": muertos }
+
+
+def crear_cola() -> ColaWebhooks:
+    return ColaWebhooks(
+        ruta=COLA_RUTA,
+        trabajadores=COLA_TRABAJADORES,
+        max_intentos=COLA_MAX_INTENTOS,
+        espera_base=COLA_ESPERA_BASE,
+        espera_max=COLA_ESPERA_MAX,
+        plazo_proceso=COLA_PLAZO_PROCESO,
+    )
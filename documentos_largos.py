@@ -0,0 +1,88 @@
+import re
+
+import tokenizador
+from normalizacion import palabras
+
+# =========================
+# Textos largos: fragmentación y mezcla de preguntas
+# =========================
+# Los textos largos se parten en fragmentos acotados por tokens, se generan
+# preguntas por fragmento en paralelo y luego se mezclan quitando las casi
+# duplicadas y respetando el máximo de preguntas.
+
+SEPARADOR_ORACIONES = re.compile(r"(?<=[.!?¿¡;:])\s+")
+
+
+def _partir_por_tokens(texto: str, max_tokens: int) -> list:
+    codificador = tokenizador.obtener_codificador()
+    # encode_ordinary: "<|endoftext|>" en el texto del usuario es texto, no un token especial
+    tokens = codificador.encode_ordinary(texto)
+    return [codificador.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+
+def _unidades(texto: str, max_tokens: int) -> list:
+    # Párrafos; si un párrafo no cabe se baja a oraciones y, en último caso, a tokens
+    unidades = []
+    for parrafo in re.split(r"\n\s*\n", texto):
+        parrafo = parrafo.strip()
+        if not parrafo:
+            continue
+        tokens_parrafo = tokenizador.contar_tokens(parrafo)
+        if tokens_parrafo <= max_tokens:
+            unidades.append((parrafo, tokens_parrafo))
+            continue
+        for oracion in SEPARADOR_ORACIONES.split(parrafo):
+            tokens_oracion = tokenizador.contar_tokens(oracion)
+            if tokens_oracion <= max_tokens:
+                unidades.append((oracion, tokens_oracion))
+            else:
+                for pedazo in _partir_por_tokens(oracion, max_tokens):
+                    unidades.append((pedazo, tokenizador.contar_tokens(pedazo)))
+    return unidades
+
+
+def dividir_en_fragmentos(texto: str, max_tokens: int) -> list:
+    fragmentos = []
+    actual = []
+    tokens_actual = 0
+
+    for unidad, tokens_unidad in _unidades(texto, max_tokens):
+        # +2 por el salto de línea que une las unidades
+        if actual and tokens_actual + tokens_unidad + 2 > max_tokens:
+            fragmentos.append("\n\n".join(actual))
+            actual = []
+            tokens_actual = 0
+        actual.append(unidad)
+        tokens_actual += tokens_unidad + 2
+
+    if actual:
+        fragmentos.append("\n\n".join(actual))
+
+    return fragmentos
+
+
+def _similitud(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def combinar_preguntas(listas: list, limite: int, umbral_duplicado: float = 0.8) -> list:
+    # Se toma una pregunta de cada fragmento por turno para cubrir todo el texto
+    combinadas = []
+    vistas = []
+    indice = 0
+
+    while len(combinadas) < limite and any(indice < len(lista) for lista in listas):
+        for lista in listas:
+            if indice >= len(lista) or len(combinadas) >= limite:
+                continue
+            pregunta = lista[indice]
+            palabras_pregunta = set(palabras(pregunta.get("pregunta", "")))
+            if any(_similitud(palabras_pregunta, otra) >= umbral_duplicado for otra in vistas):
+                continue
+            vistas.append(palabras_pregunta)
+            combinadas.append(pregunta)
+        indice += 1
+
+    return combinadas
@@ -0,0 +1,389 @@
+import asyncio
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from normalizacion import sin_acentos
+
+# =========================
+# Índice local de palabras clave → materia / subrama
+# =========================
+# Se alimenta con los resultados de gpt-4o. Guarda, por palabra normalizada
+# (minúsculas, sin acentos, singular aproximado), la materia y subrama que le
+# asignó el modelo. También recuerda las palabras que el modelo vio en el
+# contenido y NO eligió como clave ("ignoradas").
+#
+# Un contenido se resuelve localmente solo si todas sus palabras candidatas
+# son conocidas (clave o ignorada) y al menos una es clave; si no, va a gpt-4o
+# y el resultado se aprende. El índice se guarda en un JSON y se recarga solo
+# cuando otro proceso lo actualiza (se compara la fecha de modificación).
+# La lectura y la escritura del JSON corren en un hilo, desde la tarea de
+# fondo; las consultas solo miran la memoria. Al recargar o guardar, el
+# índice nuevo se arma fuera del lock (lo del disco más lo aprendido desde
+# el último guardado) y se reemplaza de una vez.
+#
+# Tamaño acotado: con más de INDICE_CLASIFICACION_MAX_CLAVES claves se
+# quitan las vistas menos veces hasta bajar al 90 % (en el próximo guardado,
+# que se adelanta), y de las ignoradas se guardan las
+# INDICE_CLASIFICACION_MAX_IGNORADAS vistas más recientemente.
+
+INDICE_RUTA = os.getenv("INDICE_CLASIFICACION_RUTA", "indice_clasificacion.json")
+INTERVALO_GUARDADO = float(os.getenv("INDICE_CLASIFICACION_GUARDADO", "30"))
+INTERVALO_RECARGA = 5.0
+INDICE_MAX_CLAVES = int(os.getenv("INDICE_CLASIFICACION_MAX_CLAVES", "50000"))
+INDICE_MAX_IGNORADAS = int(os.getenv("INDICE_CLASIFICACION_MAX_IGNORADAS", "200000"))
+MAX_PALABRAS_CLAVE = 3
+# Claves de varias palabras ("Revolución Francesa") hasta este largo
+MAX_NGRAMA = 3
+
+PALABRAS_VACIAS = set("""
+a al algo algun alguna algunas alguno algunos ante antes aquel aquella aquellas aquellos aqui asi aun aunque
+bajo bien cada casi como con contra cual cuales cualquier cuando cuanto de del desde donde dos durante e el
+ella ellas ellos en entre era eran es esa esas ese eso esos esta estaba estaban estan estar este esto estos
+fue fueron gran grande ha haber habia han hasta hay la las le les lo los mas me mediante menos mi mientras
+mismo mucho muchos muy nada ni ninguna ninguno no nos nosotros o otra otras otro otros para pero poco por
+porque puede pueden que quien quienes se segun ser sera si sido siempre sin sino sobre su sus tal tambien
+tan tanto te tiene tienen todo todos tras tu un una unas uno unos usted y ya cual cuales cuantos cuantas
+que quien cuya cuyo donde pregunta preguntas respuesta respuestas tema temas correcta correcto opcion
+opciones siguiente siguientes verdadero falso principal principales tipo tipos forma formas parte partes
+""".split())
+
+
+def _singular(palabra: str) -> str:
+    # Lematización aproximada del plural en español
+    if len(palabra) <= 4:
+        return palabra
+    if palabra.endswith("ces"):
+        return palabra[:-3] + "z"
+    if palabra.endswith("iones"):
+        return palabra[:-2]
+    if palabra.endswith("es") and palabra[-3] in "rlndj":
+        return palabra[:-2]
+    if palabra.endswith("s") and palabra[-2] in "aeiou":
+        return palabra[:-1]
+    return palabra
+
+
+def _tokens(texto: str) -> list:
+    return re.findall(r"[a-zñ]+", sin_acentos(texto.lower()).replace("ñ", "n"))
+
+
+def normalizar_clave(palabra: str) -> str:
+    return " ".join(_singular(t) for t in _tokens(palabra))
+
+
+def _candidatas(contenido: list) -> list:
+    tokens = []
+    for texto in contenido:
+        tokens.extend(_tokens(str(texto)))
+    return [_singular(t) for t in tokens if len(t) >= 4 and t not in PALABRAS_VACIAS]
+
+
+class IndiceClasificacion:
+    def __init__(self, ruta: str, max_claves: int = INDICE_MAX_CLAVES, max_ignoradas: int = INDICE_MAX_IGNORADAS):
+        self.ruta = ruta
+        self.max_claves = max_claves
+        self.max_ignoradas = max_ignoradas
+        # clave normalizada → [materia, subrama, palabra original, veces vista]
+        self._claves = {}
+        # palabra → None, de la vista hace más tiempo a la más reciente
+        self._ignoradas = OrderedDict()
+        self._lock = threading.Lock()
+        # Recargas y guardados, de a uno (el guardado final puede coincidir con uno periódico)
+        self._lock_disco = threading.Lock()
+        # Aprendido desde el último guardado: clave → entrada y palabras ignoradas, en orden
+        self._cambios_claves = {}
+        self._cambios_ignoradas = OrderedDict()
+        # Ignoradas que reaparecieron en una consulta (solo mantienen su lugar en el LRU)
+        self._vistas = OrderedDict()
+        self._mtime = None
+        self.aciertos = 0
+        self.fallos = 0
+        self.podadas = 0
+        self._tarea = None
+        self.cargar()
+
+    # ---- Persistencia ----
+
+    def _leer_disco(self):
+        try:
+            with open(self.ruta, encoding="utf-8") as archivo:
+                return json.load(archivo), os.path.getmtime(self.ruta)
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError) as e:
+            print("❌ No se pudo leer el índice de clasificación:", str(e))
+            return None, None
+
+    def _ignorar(self, palabra: str):
+        # Con el lock tomado
+        self._ignoradas[palabra] = None
+        self._ignoradas.move_to_end(palabra)
+        self._cambios_ignoradas[palabra] = None
+        self._cambios_ignoradas.move_to_end(palabra)
+
+    def _podar_estructuras(self, claves: dict, ignoradas: OrderedDict):
+        # Baja al 90 % para no podar en cada aprendizaje
+        if len(claves) > self.max_claves:
+            sobrantes = len(claves) - int(self.max_claves * 0.9)
+            # A igual frecuencia se van las que entraron primero
+            for clave in heapq.nsmallest(sobrantes, claves, key=lambda c: claves[c][3]):
+                del claves[clave]
+            self.podadas += sobrantes
+        while len(ignoradas) > self.max_ignoradas:
+            ignoradas.popitem(last=False)
+            self.podadas += 1
+
+    def _podar_ignoradas(self):
+        # Con el lock tomado. Las claves de más se podan al reconstruir, fuera del
+        # lock (la tarea de fondo guarda antes de tiempo si pasan del máximo).
+        while len(self._ignoradas) > self.max_ignoradas:
+            self._ignoradas.popitem(last=False)
+            self.podadas += 1
+
+    def _copiar_cambios(self):
+        # Con el lock tomado: lo aprendido mientras se reconstruía
+        return (
+            { clave: list(entrada) for clave, entrada in self._cambios_claves.items() },
+            list(self._cambios_ignoradas),
+            list(self._vistas)
+        )
+
+    @staticmethod
+    def _aplicar_cambios(claves: dict, ignoradas: OrderedDict, cambios):
+        cambios_claves, cambios_ignoradas, vistas = cambios
+        for clave, entrada in cambios_claves.items():
+            actual = claves.get(clave)
+            if actual is None or entrada[3] > actual[3]:
+                claves[clave] = entrada
+            ignoradas.pop(clave, None)
+        for palabra in cambios_ignoradas:
+            if palabra not in claves:
+                ignoradas[palabra] = None
+                ignoradas.move_to_end(palabra)
+        for palabra in vistas:
+            if palabra in ignoradas:
+                ignoradas.move_to_end(palabra)
+
+    def _reconstruir(self, datos, escribir: bool):
+        # Bloqueante. Arma el índice nuevo (lo del disco más lo aprendido aquí) fuera
+        # del lock; el lock se toma solo para copiar los cambios y para el reemplazo.
+        with self._lock:
+            # Solo se cambian las referencias: desde aquí aprender() anota en otros
+            tomados = (self._cambios_claves, self._cambios_ignoradas, self._vistas)
+            self._cambios_claves, self._cambios_ignoradas, self._vistas = {}, OrderedDict(), OrderedDict()
+            if datos is None:
+                # Sin archivo (o ilegible): la base es lo que hay en memoria
+                datos = { "claves": dict(self._claves), "ignoradas": list(self._ignoradas) }
+
+        cambios_claves, cambios_ignoradas, vistas = tomados
+        pendientes = (
+            { clave: list(entrada) for clave, entrada in cambios_claves.items() },
+            list(cambios_ignoradas),
+            list(vistas)
+        )
+        try:
+            # En el archivo las ignoradas van de la más antigua a la más reciente
+            claves = { clave: list(entrada) for clave, entrada in datos.get("claves", {}).items() }
+            ignoradas = OrderedDict.fromkeys(p for p in datos.get("ignoradas", []) if p not in claves)
+            self._aplicar_cambios(claves, ignoradas, pendientes)
+            self._podar_estructuras(claves, ignoradas)
+
+            if escribir:
+                contenido = { "claves": claves, "ignoradas": list(ignoradas) }
+                temporal = f"{self.ruta}.tmp"
+                with open(temporal, "w", encoding="utf-8") as archivo:
+                    json.dump(contenido, archivo, ensure_ascii=False)
+                os.replace(temporal, self.ruta)
+                self._mtime = os.path.getmtime(self.ruta)
+        except BaseException:
+            self._devolver_cambios(pendientes)
+            raise
+
+        with self._lock:
+            # Lo aprendido mientras se armaba sigue pendiente; se copia al índice nuevo
+            self._aplicar_cambios(claves, ignoradas, self._copiar_cambios())
+            # Lo viejo se suelta fuera del lock: liberar un dict grande también tarda
+            viejos = (self._claves, self._ignoradas)
+            self._claves, self._ignoradas = claves, ignoradas
+        del viejos
+        if not escribir:
+            self._devolver_cambios(pendientes)
+
+    def _devolver_cambios(self, pendientes):
+        # Cambios que no llegaron al disco: quedan para el próximo guardado
+        cambios_claves, cambios_ignoradas, vistas = pendientes
+        with self._lock:
+            for clave, entrada in cambios_claves.items():
+                self._cambios_claves.setdefault(clave, self._claves.get(clave, entrada))
+            for palabra in cambios_ignoradas:
+                self._cambios_ignoradas.setdefault(palabra, None)
+            for palabra in vistas:
+                self._vistas.setdefault(palabra, None)
+
+    def cargar(self):
+        with self._lock_disco:
+            datos, mtime = self._leer_disco()
+            if datos is not None:
+                self._reconstruir(datos, escribir=False)
+            self._mtime = mtime
+
+    def recargar_si_cambio(self):
+        # Bloqueante: corre en un hilo desde la tarea de fondo
+        try:
+            mtime = os.path.getmtime(self.ruta)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.cargar()
+
+    def guardar(self):
+        # Se mezcla con lo que haya en disco para no pisar lo aprendido por otros procesos
+        with self._lock_disco:
+            if not self._cambios_claves and not self._cambios_ignoradas:
+                return
+            datos, _ = self._leer_disco()
+            self._reconstruir(datos, escribir=True)
+
+    async def _mantener_periodicamente(self, intervalo: float):
+        # Recarga lo que escriban otros procesos cada INTERVALO_RECARGA s y guarda cada `intervalo` s
+        ultimo_guardado = time.monotonic()
+        while True:
+            await asyncio.sleep(min(INTERVALO_RECARGA, intervalo))
+            try:
+                await asyncio.to_thread(self.recargar_si_cambio)
+            except Exception as e:
+                print("❌ No se pudo recargar el índice de clasificación:", str(e))
+            if time.monotonic() - ultimo_guardado < intervalo and len(self._claves) <= self.max_claves:
+                continue
+            ultimo_guardado = time.monotonic()
+            try:
+                await asyncio.to_thread(self.guardar)
+            except Exception as e:
+                print("❌ No se pudo guardar el índice de clasificación:", str(e))
+
+    async def iniciar(self, intervalo: float = INTERVALO_GUARDADO):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._mantener_periodicamente(intervalo))
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+        await asyncio.to_thread(self.guardar)
+
+    # ---- Aprendizaje ----
+
+    def aprender(self, contenido: list, datos: dict):
+        clasificadas = datos.get("clasificadas") if isinstance(datos, dict) else None
+        if not isinstance(clasificadas, dict):
+            return
+
+        partes_clave = set()
+        with self._lock:
+            for materia, subramas in clasificadas.items():
+                if not isinstance(subramas, dict):
+                    continue
+                for subrama, palabras in subramas.items():
+                    for palabra in palabras if isinstance(palabras, list) else []:
+                        clave = normalizar_clave(str(palabra))
+                        if not clave:
+                            continue
+                        entrada = self._claves.get(clave)
+                        if entrada is None:
+                            entrada = self._claves[clave] = [materia, subrama, str(palabra), 1]
+                        else:
+                            entrada[3] += 1
+                        self._cambios_claves[clave] = entrada
+                        partes_clave.update(clave.split())
+                        self._ignoradas.pop(clave, None)
+                        self._cambios_ignoradas.pop(clave, None)
+
+            for candidata in _candidatas(contenido):
+                if candidata not in self._claves and candidata not in partes_clave:
+                    self._ignorar(candidata)
+
+            self._podar_ignoradas()
+
+    # ---- Consulta ----
+
+    def _claves_presentes(self, contenido: list):
+        # Devuelve (claves encontradas con su frecuencia, True si todo es conocido)
+        candidatas = _candidatas(contenido)
+        if not candidatas:
+            return None, False
+
+        encontradas = Counter()
+        cubiertas = set()
+        for n in range(MAX_NGRAMA, 0, -1):
+            for i in range(len(candidatas) - n + 1):
+                clave = " ".join(candidatas[i:i + n])
+                if clave in self._claves:
+                    encontradas[clave] += 1
+                    cubiertas.update(range(i, i + n))
+
+        todo_conocido = all(
+            i in cubiertas or c in self._ignoradas for i, c in enumerate(candidatas)
+        )
+        if todo_conocido:
+            # Las ignoradas que siguen apareciendo no se desalojan
+            for i, c in enumerate(candidatas):
+                if i not in cubiertas:
+                    self._ignoradas.move_to_end(c)
+                    self._vistas[c] = None
+        return encontradas, todo_conocido
+
+    def _registrar(self, acierto: bool):
+        if acierto:
+            self.aciertos += 1
+        else:
+            self.fallos += 1
+
+    def clasificar(self, contenido: list, max_palabras: int = MAX_PALABRAS_CLAVE):
+        # Mismo formato que devuelve gpt-4o, o None si hay que preguntarle
+        with self._lock:
+            encontradas, todo_conocido = self._claves_presentes(contenido)
+            if not todo_conocido or not encontradas:
+                self._registrar(False)
+                return None
+
+            # Igual que en el prompt: se prefieren las palabras menos repetidas
+            elegidas = sorted(encontradas, key=lambda c: (encontradas[c], -self._claves[c][3]))[:max_palabras]
+            clasificadas = {}
+            for clave in elegidas:
+                materia, subrama, original, _ = self._claves[clave]
+                clasificadas.setdefault(materia, {}).setdefault(subrama, []).append(original)
+
+            self._registrar(True)
+            return { "clasificadas": clasificadas }
+
+    def materia(self, contenido: list):
+        # Materia con más apariciones entre las claves del contenido, o None si hay que preguntarle a gpt-4o
+        with self._lock:
+            encontradas, todo_conocido = self._claves_presentes(contenido)
+            if not todo_conocido or not encontradas:
+                self._registrar(False)
+                return None
+
+            votos = Counter()
+            for clave, veces in encontradas.items():
+                votos[self._claves[clave][0]] += veces
+
+            self._registrar(True)
+            return votos.most_common(1)[0][0]
+
+    def estadisticas(self) -> dict:
+        consultas = self.aciertos + self.fallos
+        return {
+            "claves": len(self._claves),
+            "ignoradas": len(self._ignoradas),
+            "podadas": self.podadas,
+            "aciertos": self.aciertos,
+            "fallos": self.fallos,
+            "tasa_aciertos": self.aciertos / consultas if consultas else 0.0
+        }
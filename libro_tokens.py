@@ -0,0 +1,153 @@
+import time
+
+from metricas import medir
+from recursos import firestore
+
+# =========================
+# Libro de tokens
+# =========================
+# Todos los cambios de saldo pasan por aquí:
+# - Créditos: firestore.Increment en un batch, un solo viaje a Firestore.
+# - Débitos: transacción con decremento condicionado al saldo disponible.
+# Cada cambio agrega un movimiento en usuarios/{uid}/movimientos. Si se da una
+# referencia (id de pago, de reserva...) se usa como id del movimiento y el
+# batch/transacción falla si ya existe, así que repetirla no cambia el saldo.
+# Si se da una caché de usuarios, los débitos le anotan el saldo que leyeron
+# (y el que dejaron) y los créditos invalidan la entrada del uid.
+# `extra` agrega campos al movimiento y `cerrar` marca como no pendiente otro
+# movimiento del mismo usuario en la misma escritura (p. ej. la reserva que
+# se está liquidando).
+
+
+class UsuarioNoEncontrado(Exception):
+    pass
+
+
+class SaldoInsuficiente(Exception):
+    pass
+
+
+class MovimientoDuplicado(Exception):
+    pass
+
+
+def _saldo(snapshot) -> int:
+    tokens = snapshot.to_dict().get('tokens', 0)
+    return tokens if isinstance(tokens, int) else 0
+
+
+class LibroTokens:
+    def __init__(self, db, cache_usuarios=None):
+        self.db = db
+        self.cache_usuarios = cache_usuarios
+
+    def _invalidar(self, uid: str, inicio: float):
+        if self.cache_usuarios is not None:
+            self.cache_usuarios.invalidar(uid, inicio)
+
+    def _anotar(self, uid: str, datos, inicio: float):
+        if self.cache_usuarios is not None:
+            self.cache_usuarios.anotar(uid, datos, inicio)
+
+    def _usuario(self, uid: str):
+        return self.db.collection('usuarios').document(uid)
+
+    def _movimiento(self, uid: str, referencia: str = None):
+        movimientos = self._usuario(uid).collection('movimientos')
+        return movimientos.document(referencia) if referencia else movimientos.document()
+
+    def _datos_movimiento(self, tipo: str, cantidad: int, motivo: str, extra: dict = None) -> dict:
+        return {
+            'tipo': tipo,
+            'cantidad': cantidad,
+            'motivo': motivo,
+            'creado': firestore.SERVER_TIMESTAMP,
+            **(extra or {})
+        }
+
+    def acreditar(self, uid: str, cantidad: int, motivo: str, referencia: str = None, crear_si_no_existe: bool = False, cerrar: str = None):
+        # Importado aquí para no cargar grpc al importar el módulo
+        from google.api_core.exceptions import AlreadyExists, NotFound
+
+        user_ref = self._usuario(uid)
+        movimiento_ref = self._movimiento(uid, referencia)
+        movimiento = self._datos_movimiento('credito', cantidad, motivo)
+
+        batch = self.db.batch()
+        if crear_si_no_existe:
+            batch.set(user_ref, { 'tokens': firestore.Increment(cantidad) }, merge=True)
+        else:
+            batch.update(user_ref, { 'tokens': firestore.Increment(cantidad) })
+
+        if referencia:
+            batch.create(movimiento_ref, movimiento)
+        else:
+            batch.set(movimiento_ref, movimiento)
+
+        if cerrar:
+            batch.set(self._movimiento(uid, cerrar), { 'pendiente': False }, merge=True)
+
+        inicio = time.monotonic()
+        try:
+            with medir("firestore_acreditar"):
+                batch.commit()
+        except NotFound:
+            raise UsuarioNoEncontrado(uid)
+        except AlreadyExists:
+            raise MovimientoDuplicado(referencia)
+        except Exception:
+            # Un commit que falló por tiempo pudo haberse aplicado
+            self._invalidar(uid, inicio)
+            raise
+        self._invalidar(uid, inicio)
+
+    def debitar(self, uid: str, cantidad: int, motivo: str, referencia: str = None, minimo: int = None, extra: dict = None, cerrar: str = None) -> int:
+        # Sin mínimo se exige el monto completo. Con mínimo se descuenta lo que
+        # alcance, siempre que el saldo llegue al mínimo. Devuelve lo descontado.
+        from google.api_core.exceptions import AlreadyExists
+
+        user_ref = self._usuario(uid)
+        movimiento_ref = self._movimiento(uid, referencia)
+        requerido = cantidad if minimo is None else minimo
+        # Lo que leyó el último intento de la transacción, para la caché de usuarios
+        leido = {}
+
+        @firestore.transactional
+        def _debitar(transaction):
+            snapshot = user_ref.get(transaction=transaction)
+            leido['datos'] = snapshot.to_dict() if snapshot.exists else None
+            if not snapshot.exists:
+                raise UsuarioNoEncontrado(uid)
+
+            saldo = _saldo(snapshot)
+            if saldo < requerido:
+                raise SaldoInsuficiente(uid)
+
+            descontados = min(cantidad, saldo)
+            transaction.update(user_ref, { 'tokens': saldo - descontados })
+            leido['datos'] = { **leido['datos'], 'tokens': saldo - descontados }
+
+            movimiento = self._datos_movimiento('debito', descontados, motivo, extra)
+            if referencia:
+                transaction.create(movimiento_ref, movimiento)
+            else:
+                transaction.set(movimiento_ref, movimiento)
+            if cerrar:
+                transaction.set(self._movimiento(uid, cerrar), { 'pendiente': False }, merge=True)
+            return descontados
+
+        inicio = time.monotonic()
+        try:
+            with medir("firestore_debitar"):
+                descontados = _debitar(self.db.transaction())
+        except AlreadyExists:
+            raise MovimientoDuplicado(referencia)
+        except (UsuarioNoEncontrado, SaldoInsuficiente):
+            # No se escribió nada, pero ya se sabe si existe y cuánto tiene
+            self._anotar(uid, leido['datos'], inicio)
+            raise
+        except Exception:
+            self._invalidar(uid, inicio)
+            raise
+        self._anotar(uid, leido['datos'], inicio)
+        return descontados
@@ -0,0 +1,291 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse
+
+# =========================
+# Métricas en formato Prometheus
+# =========================
+# Registro en memoria de contadores, medidores e histogramas con etiquetas,
+# sin dependencias externas. Cada app expone /metrics con instalar(app):
+# - Middleware ASGI: solicitudes en curso, duración y total por ruta y estado.
+# - medir("etapa"): histograma de duración, errores y llamadas en curso de cada
+#   tramo (OpenAI, Firestore, PayPal, parseo de JSON...).
+# - Recolectores: funciones que devuelven estadísticas (caché, índice, cola)
+#   y se leen solo cuando Prometheus consulta /metrics. Algunos leen SQLite o
+#   esperan un lock, así que la exportación corre en un hilo.
+# Con LOG_JSON=1 cada solicitud deja además una línea JSON en el log.
+
+PREFIJO = "quizforge"
+LOG_JSON = os.getenv("LOG_JSON", "0") == "1"
+
+# Segundos. Las llamadas a OpenAI pueden tardar decenas de segundos.
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 90)
+
+
+def _formatear_etiquetas(nombres: tuple, valores: tuple) -> str:
+    if not nombres:
+        return ""
+    partes = []
+    for nombre, valor in zip(nombres, valores):
+        valor = str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        partes.append(f'{nombre}="{valor}"')
+    return "{" + ",".join(partes) + "}"
+
+
+def _formatear_numero(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _clave(self, etiquetas: dict) -> tuple:
+        return tuple(etiquetas.get(nombre, "") for nombre in self.etiquetas)
+
+    def exportar(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        with self._lock:
+            for clave, valor in sorted(self._valores.items()):
+                lineas.append(f"{self.nombre}{_formatear_etiquetas(self.etiquetas, clave)} {_formatear_numero(valor)}")
+        return lineas
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, cantidad: float = 1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def inc(self, cantidad: float = 1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + cantidad
+
+    def dec(self, cantidad: float = 1, **etiquetas):
+        self.inc(-cantidad, **etiquetas)
+
+    def fijar(self, valor: float, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._valores[clave] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor: float, **etiquetas):
+        clave = self._clave(etiquetas)
+        posicion = bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._valores.get(clave)
+            if serie is None:
+                # [conteos por bucket (no acumulados)..., +Inf], suma
+                serie = self._valores[clave] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][posicion] += 1
+            serie[1] += valor
+
+    def exportar(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        nombres_bucket = self.etiquetas + ("le",)
+        with self._lock:
+            for clave, (conteos, suma) in sorted(self._valores.items()):
+                acumulado = 0
+                for limite, conteo in zip(self.buckets + (float("inf"),), conteos):
+                    acumulado += conteo
+                    etiquetas = _formatear_etiquetas(nombres_bucket, clave + (_formatear_numero(limite),))
+                    lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+                etiquetas = _formatear_etiquetas(self.etiquetas, clave)
+                lineas.append(f"{self.nombre}_sum{etiquetas} {_formatear_numero(suma)}")
+                lineas.append(f"{self.nombre}_count{etiquetas} {acumulado}")
+        return lineas
+
+
+class Registro:
+    def __init__(self):
+        self._metricas = {}
+        self._recolectores = {}
+        self._lock = threading.Lock()
+
+    def _registrar(self, clase, nombre: str, *args, **kwargs):
+        nombre = f"{PREFIJO}_{nombre}"
+        with self._lock:
+            if nombre not in self._metricas:
+                self._metricas[nombre] = clase(nombre, *args, **kwargs)
+            return self._metricas[nombre]
+
+    def contador(self, nombre: str, ayuda: str, etiquetas: tuple = ()) -> Contador:
+        return self._registrar(Contador, nombre, ayuda, etiquetas)
+
+    def medidor(self, nombre: str, ayuda: str, etiquetas: tuple = ()) -> Medidor:
+        return self._registrar(Medidor, nombre, ayuda, etiquetas)
+
+    def histograma(self, nombre: str, ayuda: str, etiquetas: tuple = (), buckets: tuple = BUCKETS_LATENCIA) -> Histograma:
+        return self._registrar(Histograma, nombre, ayuda, etiquetas, buckets=buckets)
+
+    def recolector(self, nombre: str, funcion):
+        # funcion() -> dict de números (puede anidar un nivel); se exporta como medidores
+        self._recolectores[nombre] = funcion
+
+    def _exportar_recolector(self, nombre: str, funcion) -> list:
+        try:
+            datos = funcion()
+        except Exception as e:
+            print(f"❌ No se pudieron leer las estadísticas de {nombre}:", str(e))
+            return []
+
+        planos = {}
+        for clave, valor in datos.items():
+            if isinstance(valor, dict):
+                for subclave, subvalor in valor.items():
+                    planos[f"{clave}_{subclave}"] = subvalor
+            else:
+                planos[clave] = valor
+
+        lineas = []
+        for clave, valor in planos.items():
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+                continue
+            metrica = f"{PREFIJO}_{nombre}_{clave}"
+            lineas.append(f"# TYPE {metrica} gauge")
+            lineas.append(f"{metrica} {_formatear_numero(valor)}")
+        return lineas
+
+    def exportar(self) -> str:
+        lineas = []
+        for metrica in list(self._metricas.values()):
+            lineas.extend(metrica.exportar())
+        for nombre, funcion in list(self._recolectores.items()):
+            lineas.extend(self._exportar_recolector(nombre, funcion))
+        return "\n".join(lineas) + "\n"
+
+
+registro = Registro()
+
+# ---- Métricas comunes ----
+
+solicitudes_total = registro.contador(
+    "http_solicitudes_total", "Solicitudes HTTP atendidas", ("app", "metodo", "ruta", "estado")
+)
+solicitudes_duracion = registro.histograma(
+    "http_duracion_segundos", "Duración de las solicitudes HTTP", ("app", "metodo", "ruta")
+)
+solicitudes_en_curso = registro.medidor(
+    "http_en_curso", "Solicitudes HTTP en curso", ("app",)
+)
+etapa_duracion = registro.histograma(
+    "etapa_duracion_segundos", "Duración de cada tramo (OpenAI, Firestore, PayPal, JSON...)", ("etapa",)
+)
+etapa_errores = registro.contador(
+    "etapa_errores_total", "Tramos que terminaron con una excepción", ("etapa",)
+)
+etapa_en_curso = registro.medidor(
+    "etapa_en_curso", "Tramos en curso", ("etapa",)
+)
+tokens_openai = registro.contador(
+    "openai_tokens_total", "Tokens reportados por OpenAI", ("modelo", "tipo")
+)
+
+
+@contextmanager
+def medir(etapa: str):
+    # Sirve tanto en código síncrono como dentro de corrutinas
+    inicio = time.perf_counter()
+    etapa_en_curso.inc(etapa=etapa)
+    try:
+        yield
+    except Exception:
+        etapa_errores.inc(etapa=etapa)
+        raise
+    finally:
+        etapa_en_curso.dec(etapa=etapa)
+        etapa_duracion.observar(time.perf_counter() - inicio, etapa=etapa)
+
+
+def registrar_uso_openai(modelo: str, uso: dict):
+    if not uso:
+        return
+    tokens_openai.inc(uso.get("prompt_tokens", 0), modelo=modelo, tipo="prompt")
+    tokens_openai.inc(uso.get("completion_tokens", 0), modelo=modelo, tipo="respuesta")
+
+
+# =========================
+# Middleware y endpoint /metrics
+# =========================
+
+class MiddlewareMetricas:
+    # ASGI puro (no BaseHTTPMiddleware) para no interferir con los streams SSE
+    def __init__(self, app, nombre_app: str):
+        self.app = app
+        self.nombre_app = nombre_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        estado = 500
+        solicitudes_en_curso.inc(app=self.nombre_app)
+
+        async def enviar(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            duracion = time.perf_counter() - inicio
+            solicitudes_en_curso.dec(app=self.nombre_app)
+
+            # Se usa la plantilla de la ruta (/clasificacion/{id}) para no crear una serie por id
+            ruta = getattr(scope.get("route"), "path", None) or "sin_ruta"
+            metodo = scope.get("method", "")
+            solicitudes_total.inc(app=self.nombre_app, metodo=metodo, ruta=ruta, estado=str(estado))
+            solicitudes_duracion.observar(duracion, app=self.nombre_app, metodo=metodo, ruta=ruta)
+
+            if LOG_JSON:
+                print(json.dumps({
+                    "app": self.nombre_app,
+                    "metodo": metodo,
+                    "ruta": ruta,
+                    "path": scope.get("path"),
+                    "estado": estado,
+                    "duracion_ms": round(duracion * 1000, 2)
+                }, ensure_ascii=False), flush=True)
+
+
+def instalar(app, nombre_app: str):
+    app.add_middleware(MiddlewareMetricas, nombre_app=nombre_app)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return PlainTextResponse(await run_in_threadpool(registro.exportar), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,23 @@
+import re
+import unicodedata
+
+# =========================
+# Normalización de texto
+# =========================
+# Comparten esto el índice de clasificación, la mezcla de preguntas de textos
+# largos y el banco de preguntas: sin acentos y en minúsculas, "Revolución"
+# y "revolucion" son la misma palabra.
+
+
+def sin_acentos(texto: str) -> str:
+    # La mayoría de los textos ya vienen sin acentos: se evita la descomposición NFD
+    if texto.isascii():
+        return texto
+    return "".join(
+        c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn"
+    )
+
+
+def palabras(texto: str) -> list:
+    # Palabras en minúsculas y sin acentos, en orden
+    return re.findall(r"\w+", sin_acentos(texto.lower()))
@@ -0,0 +1,81 @@
+import re
+
+import orjson
+
+# =========================
+# Parser incremental de preguntas
+# =========================
+# Recibe la respuesta del modelo por fragmentos y devuelve cada objeto del
+# arreglo "preguntas" en cuanto se cierra su llave, sin esperar el JSON completo.
+
+INICIO_PREGUNTAS = re.compile(r'"preguntas"\s*:\s*\[')
+
+
+class ParserPreguntasIncremental:
+    def __init__(self):
+        self._pendiente = ""
+        self._en_arreglo = False
+        self._pos = 0
+        self._profundidad = 0
+        self._en_cadena = False
+        self._escape = False
+        self._inicio_objeto = None
+        self.terminado = False
+
+    def alimentar(self, fragmento: str) -> list:
+        if self.terminado:
+            return []
+
+        self._pendiente += fragmento
+
+        if not self._en_arreglo:
+            inicio = INICIO_PREGUNTAS.search(self._pendiente)
+            if inicio is None:
+                return []
+            self._en_arreglo = True
+            self._pendiente = self._pendiente[inicio.end():]
+            self._pos = 0
+
+        objetos = []
+        texto = self._pendiente
+        i = self._pos
+
+        while i < len(texto):
+            c = texto[i]
+            if self._en_cadena:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._en_cadena = False
+            elif c == '"':
+                self._en_cadena = True
+            elif c == "{":
+                if self._profundidad == 0:
+                    self._inicio_objeto = i
+                self._profundidad += 1
+            elif c == "}":
+                self._profundidad -= 1
+                if self._profundidad == 0 and self._inicio_objeto is not None:
+                    try:
+                        objeto = orjson.loads(texto[self._inicio_objeto:i + 1])
+                        if isinstance(objeto, dict):
+                            objetos.append(objeto)
+                    except ValueError:
+                        pass
+                    self._inicio_objeto = None
+            elif c == "]" and self._profundidad == 0:
+                self.terminado = True
+                i += 1
+                break
+            i += 1
+
+        # Se descarta lo ya procesado para que el buffer no crezca con la respuesta
+        corte = self._inicio_objeto if self._inicio_objeto is not None else i
+        self._pendiente = texto[corte:]
+        self._pos = i - corte
+        if self._inicio_objeto is not None:
+            self._inicio_objeto = 0
+
+        return objetos
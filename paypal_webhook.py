@@ -1,17 +1,29 @@
 from fastapi import FastAPI, Request, HTTPException
-import firebase_admin
-from firebase_admin import credentials, firestore
 from pydantic import BaseModel
-import json
+from libro_tokens import LibroTokens, MovimientoDuplicado, UsuarioNoEncontrado
+from cola_webhooks import ErrorPermanente, crear_cola
+import metricas
+from recursos import db, iniciar_calentamiento, instalar_salud, recurso_firestore
+import uuid
 
 app = FastAPI()
 
-# Inicializar Firebase Admin SDK
-if not firebase_admin._apps:
-    cred = credentials.Certificate('/etc/secrets/quizforge-bf3c3-firebase-adminsdk-fbsvc-7b3f56d424')
-    firebase_admin.initialize_app(cred)
+# Firebase Admin y el cliente de Firestore se crean en el primer uso (ver recursos.py)
+libro = LibroTokens(db)
+cola_webhooks = crear_cola()
 
-db = firestore.client()
+metricas.instalar(app, "paypal_ipn")
+metricas.registro.recolector("cola_webhooks", cola_webhooks.estadisticas)
+instalar_salud(app, [recurso_firestore])
+
+@app.on_event("startup")
+async def iniciar_cola():
+    await iniciar_calentamiento(recurso_firestore)
+    await cola_webhooks.iniciar()
+
+@app.on_event("shutdown")
+async def detener_cola():
+    await cola_webhooks.detener()
 
 class PayPalIPN(BaseModel):
     pass  # No campos estrictos porque PayPal envía muchos datos
@@ -42,13 +54,36 @@ async def paypal_webhook(request: Request):
     else:
         raise HTTPException(status_code=400, detail="Monto no válido.")
 
-    user_ref = db.collection('usuarios').document(user_uid)
-    user_doc = user_ref.get()
+    # Se guarda en la cola local y se responde de inmediato; Firestore se actualiza en segundo plano.
+    # La transacción de PayPal deduplica tanto la cola como el libro de tokens.
+    txn_id = data.get("txn_id")
+    clave = f"ipn-{txn_id}" if txn_id else f"ipn-sin-id-{uuid.uuid4().hex}"
+    nuevo = await cola_webhooks.encolar("paypal_ipn", clave, {
+        "uid": user_uid,
+        "tokens": tokens_to_add,
+        "txn_id": txn_id
+    })
 
-    if user_doc.exists:
-        current_tokens = user_doc.to_dict().get('tokens', 0)
-        user_ref.update({'tokens': current_tokens + tokens_to_add})
-        print(f"✅ Tokens actualizados para UID {user_uid}: {current_tokens} ➡️ {current_tokens + tokens_to_add}")
-        return {"message": "Tokens agregados exitosamente."}
-    else:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado.")
+    if not nuevo:
+        print(f"✅ Transacción {txn_id} repetida, se ignora.")
+    return {"message": "Evento recibido, los tokens se acreditarán en breve."}
+
+
+def procesar_ipn(payload: dict):
+    txn_id = payload.get("txn_id")
+    try:
+        libro.acreditar(
+            payload["uid"],
+            payload["tokens"],
+            "paypal_ipn",
+            referencia=f"paypal-ipn-{txn_id}" if txn_id else None
+        )
+    except UsuarioNoEncontrado:
+        raise ErrorPermanente(f"Usuario no encontrado: {payload['uid']}")
+    except MovimientoDuplicado:
+        print(f"✅ La transacción {txn_id} ya estaba acreditada para UID {payload['uid']}")
+        return
+
+    print(f"✅ {payload['tokens']} tokens acreditados a UID {payload['uid']}")
+
+cola_webhooks.registrar("paypal_ipn", procesar_ipn)
@@ -0,0 +1,313 @@
+import asyncio
+import heapq
+import os
+import re
+import threading
+import time
+
+from indice_clasificacion import normalizar_clave
+from metricas import medir
+from recursos import firestore
+
+# =========================
+# Perfil de palabras clave por usuario
+# =========================
+# Reemplaza el campo palabras_clave del documento del usuario, donde cada
+# clasificación pisaba el peso anterior con 1.0 y el documento crecía sin
+# límite. Ahora cada usuario tiene una subcolección perfil_palabras:
+# - Un documento por materia: subramas.{subrama}.{palabra} = { peso, palabra }.
+#   El peso se suma con Increment, así que varios workers pueden escribir a
+#   la vez sin leer antes.
+# - _resumen: totales por materia/subrama (también con Increment) y las
+#   PERFIL_TOP_K palabras de más peso de cada materia. /temas-debiles/ lee
+#   solo este documento.
+#
+# Las clasificaciones se juntan en memoria por usuario y palabra y se
+# escriben cada PERFIL_INTERVALO segundos (o antes si se juntan
+# PERFIL_MAX_PENDIENTES palabras): diez clasificaciones seguidas de la misma
+# palabra son una sola escritura.
+#
+# Decaimiento: los pesos pierden la mitad cada PERFIL_VIDA_MEDIA_DIAS. Para
+# no tener que reescribir todo, cada suma se guarda multiplicada por
+# escala(ahora), que crece con el tiempo, y al leer se divide entre la escala
+# del momento. Lo viejo queda con menos peso que lo nuevo sin tocarlo.
+
+PERFIL_INTERVALO = float(os.getenv("PERFIL_INTERVALO", "5"))
+PERFIL_MAX_PENDIENTES = int(os.getenv("PERFIL_MAX_PENDIENTES", "2000"))
+PERFIL_VIDA_MEDIA_DIAS = float(os.getenv("PERFIL_VIDA_MEDIA_DIAS", "30"))
+PERFIL_TOP_K = int(os.getenv("PERFIL_TOP_K", "10"))
+# Al pasar de aquí se borran las palabras de menos peso de la materia
+PERFIL_MAX_PALABRAS_MATERIA = int(os.getenv("PERFIL_MAX_PALABRAS_MATERIA", "300"))
+
+PESO_APARICION = 1.0
+# 2024-01-01 UTC: referencia de la escala (con 30 días de vida media no se desborda en unos 80 años)
+EPOCA = 1704067200
+DOC_RESUMEN = "_resumen"
+# Un WriteBatch admite 500 escrituras
+MAX_ESCRITURAS_LOTE = 400
+
+# Caracteres que no pueden ir en un nombre de campo sin comillas ni en un id de documento
+CARACTERES_INVALIDOS = re.compile(r"[.~*/\[\]`]")
+
+
+def escala(instante: float = None) -> float:
+    instante = time.time() if instante is None else instante
+    return 2.0 ** ((instante - EPOCA) / (PERFIL_VIDA_MEDIA_DIAS * 86400))
+
+
+def _campo(nombre) -> str:
+    return " ".join(CARACTERES_INVALIDOS.sub(" ", str(nombre)).split())
+
+
+class PerfilPalabras:
+    def __init__(self, db):
+        self.db = db
+        # uid -> { (materia, subrama, clave): [palabra original, peso] }
+        self._pendientes = {}
+        self._total_pendientes = 0
+        self._lock = threading.Lock()
+        self._tarea = None
+        self._despertar = None
+        self.registradas = 0
+        self.escrituras = 0
+        self.vaciados = 0
+        self.errores = 0
+
+    def _perfil(self, uid: str):
+        return self.db.collection("usuarios").document(uid).collection("perfil_palabras")
+
+    # ---- Buffer ----
+
+    def registrar(self, uid: str, datos: dict):
+        clasificadas = datos.get("clasificadas") if isinstance(datos, dict) else None
+        if not isinstance(clasificadas, dict):
+            return
+
+        with self._lock:
+            usuario = self._pendientes.setdefault(uid, {})
+            for materia, subramas in clasificadas.items():
+                materia = _campo(materia)
+                if not materia or materia == DOC_RESUMEN or not isinstance(subramas, dict):
+                    continue
+                for subrama, palabras in subramas.items():
+                    subrama = _campo(subrama)
+                    if not subrama:
+                        continue
+                    for palabra in palabras if isinstance(palabras, list) else []:
+                        clave = normalizar_clave(str(palabra)).replace(" ", "_")
+                        if not clave:
+                            continue
+                        entrada = usuario.get((materia, subrama, clave))
+                        if entrada is None:
+                            usuario[(materia, subrama, clave)] = [str(palabra), PESO_APARICION]
+                            self._total_pendientes += 1
+                        else:
+                            entrada[0] = str(palabra)
+                            entrada[1] += PESO_APARICION
+                        self.registradas += 1
+            if not usuario:
+                del self._pendientes[uid]
+            lleno = self._total_pendientes >= PERFIL_MAX_PENDIENTES
+
+        if lleno and self._despertar is not None:
+            self._despertar.set()
+
+    def _devolver(self, pendientes: dict):
+        # Lo que no se pudo escribir vuelve al buffer para el siguiente intento
+        with self._lock:
+            for uid, palabras in pendientes.items():
+                usuario = self._pendientes.setdefault(uid, {})
+                for llave, (palabra, peso) in palabras.items():
+                    entrada = usuario.get(llave)
+                    if entrada is None:
+                        usuario[llave] = [palabra, peso]
+                        self._total_pendientes += 1
+                    else:
+                        entrada[1] += peso
+
+    # ---- Escritura ----
+
+    def vaciar(self):
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+            self._total_pendientes = 0
+        if not pendientes:
+            return
+
+        fallidos = self._escribir_pesos(pendientes)
+        if fallidos:
+            self.errores += 1
+            self._devolver(fallidos)
+        self.vaciados += 1
+
+        escritos = { uid: palabras for uid, palabras in pendientes.items() if uid not in fallidos }
+        if escritos:
+            try:
+                self._actualizar_resumenes(escritos)
+            except Exception as e:
+                # Los pesos ya están guardados; el resumen se rehace en la próxima escritura del usuario
+                print("❌ No se pudo actualizar el resumen del perfil de palabras:", str(e))
+
+    def _confirmar(self, lote, usuarios: list, escrituras: int, pendientes: dict, fallidos: dict):
+        try:
+            with medir("firestore_perfil_palabras"):
+                lote.commit()
+            self.escrituras += escrituras
+        except Exception as e:
+            print("❌ No se pudo guardar el perfil de palabras:", str(e))
+            for uid in usuarios:
+                fallidos[uid] = pendientes[uid]
+
+    def _escribir_pesos(self, pendientes: dict) -> dict:
+        # Devuelve { uid: pendientes } de los lotes que fallaron (un lote es todo o nada)
+        factor = escala()
+        fallidos = {}
+        lote, usuarios, escrituras = self.db.batch(), [], 0
+
+        for uid, palabras in pendientes.items():
+            materias = {}
+            totales = {}
+            for (materia, subrama, clave), (palabra, peso) in palabras.items():
+                suma = peso * factor
+                materias.setdefault(materia, {}).setdefault(subrama, {})[clave] = {
+                    "peso": firestore.Increment(suma),
+                    "palabra": palabra
+                }
+                subtotales = totales.setdefault(materia, {})
+                subtotales[subrama] = subtotales.get(subrama, 0.0) + suma
+
+            perfil = self._perfil(uid)
+            for materia, subramas in materias.items():
+                lote.set(perfil.document(materia), {
+                    "subramas": subramas,
+                    "actualizado": firestore.SERVER_TIMESTAMP
+                }, merge=True)
+            lote.set(perfil.document(DOC_RESUMEN), {
+                "totales": {
+                    materia: { subrama: firestore.Increment(suma) for subrama, suma in subtotales.items() }
+                    for materia, subtotales in totales.items()
+                },
+                "actualizado": firestore.SERVER_TIMESTAMP
+            }, merge=True)
+
+            usuarios.append(uid)
+            escrituras += len(materias) + 1
+            if escrituras >= MAX_ESCRITURAS_LOTE:
+                self._confirmar(lote, usuarios, escrituras, pendientes, fallidos)
+                lote, usuarios, escrituras = self.db.batch(), [], 0
+
+        if usuarios:
+            self._confirmar(lote, usuarios, escrituras, pendientes, fallidos)
+        return fallidos
+
+    def _actualizar_resumenes(self, escritos: dict):
+        # Se releen las materias tocadas (ya con los Increment aplicados) para
+        # rehacer su top; de paso se podan las que se pasaron del máximo.
+        referencias = {}
+        for uid, palabras in escritos.items():
+            perfil = self._perfil(uid)
+            for materia in { materia for materia, _, _ in palabras }:
+                referencia = perfil.document(materia)
+                referencias[referencia.path] = (referencia, uid, materia)
+
+        # get_all no garantiza el orden: se empareja por ruta
+        with medir("firestore_perfil_palabras"):
+            documentos = list(self.db.get_all([referencia for referencia, _, _ in referencias.values()]))
+
+        tops = {}
+        podas = []
+        for documento in documentos:
+            if not documento.exists or documento.reference.path not in referencias:
+                continue
+            _, uid, materia = referencias[documento.reference.path]
+            entradas = [
+                (datos.get("peso", 0.0), subrama, clave, datos.get("palabra", clave))
+                for subrama, palabras in (documento.to_dict() or {}).get("subramas", {}).items()
+                for clave, datos in palabras.items()
+                if isinstance(datos, dict)
+            ]
+            if len(entradas) > PERFIL_MAX_PALABRAS_MATERIA:
+                sobrantes = heapq.nsmallest(len(entradas) - PERFIL_MAX_PALABRAS_MATERIA, entradas)
+                podas.append((documento.reference, {
+                    f"subramas.{subrama}.{clave}": firestore.DELETE_FIELD for _, subrama, clave, _ in sobrantes
+                }))
+                entradas = heapq.nlargest(PERFIL_MAX_PALABRAS_MATERIA, entradas)
+            tops.setdefault(uid, {})[materia] = [
+                { "palabra": palabra, "subrama": subrama, "peso": peso }
+                for peso, subrama, _, palabra in heapq.nlargest(PERFIL_TOP_K, entradas)
+            ]
+
+        lote, escrituras = self.db.batch(), 0
+        for uid, top in tops.items():
+            lote.set(self._perfil(uid).document(DOC_RESUMEN), { "top": top }, merge=True)
+            escrituras += 1
+        for referencia, campos in podas:
+            lote.update(referencia, campos)
+            escrituras += 1
+        if escrituras:
+            with medir("firestore_perfil_palabras"):
+                lote.commit()
+            self.escrituras += escrituras
+
+    async def _vaciar_periodicamente(self, intervalo: float):
+        while True:
+            try:
+                await asyncio.wait_for(self._despertar.wait(), intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+            try:
+                await asyncio.to_thread(self.vaciar)
+            except Exception as e:
+                print("❌ No se pudo guardar el perfil de palabras:", str(e))
+
+    async def iniciar(self, intervalo: float = PERFIL_INTERVALO):
+        if self._tarea is None:
+            self._despertar = asyncio.Event()
+            self._tarea = asyncio.create_task(self._vaciar_periodicamente(intervalo))
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+        await asyncio.to_thread(self.vaciar)
+
+    # ---- Lectura ----
+
+    def temas_debiles(self, uid: str, limite: int = 5) -> dict:
+        # Subramas y palabras con más peso acumulado, ya con el decaimiento aplicado
+        with medir("firestore_perfil_palabras"):
+            documento = self._perfil(uid).document(DOC_RESUMEN).get()
+        datos = documento.to_dict() if documento.exists else {}
+        factor = escala()
+
+        temas = [
+            { "materia": materia, "subrama": subrama, "peso": round(suma / factor, 4) }
+            for materia, subtotales in datos.get("totales", {}).items()
+            for subrama, suma in subtotales.items()
+        ]
+        palabras = [
+            { "palabra": entrada["palabra"], "materia": materia, "subrama": entrada["subrama"],
+              "peso": round(entrada["peso"] / factor, 4) }
+            for materia, top in datos.get("top", {}).items()
+            for entrada in top
+        ]
+        return {
+            "temas": heapq.nlargest(limite, temas, key=lambda tema: tema["peso"]),
+            "palabras": heapq.nlargest(limite, palabras, key=lambda palabra: palabra["peso"])
+        }
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            usuarios_pendientes = len(self._pendientes)
+            palabras_pendientes = self._total_pendientes
+        return {
+            "usuarios_pendientes": usuarios_pendientes,
+            "palabras_pendientes": palabras_pendientes,
+            "registradas": self.registradas,
+            "escrituras": self.escrituras,
+            "vaciados": self.vaciados,
+            "errores": self.errores,
+            "palabras_por_escritura": self.registradas / self.escrituras if self.escrituras else 0.0
+        }
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from libro_tokens import LibroTokens, MovimientoDuplicado, UsuarioNoEncontrado
+from metricas import medir
+
+# =========================
+# Reservas de tokens antes de llamar a OpenAI
+# =========================
+# Antes de la llamada se retiene del saldo lo máximo que podría costar
+# (prompt estimado + max_tokens). Al terminar se liquida: se devuelve lo que
+# sobró o se cobra la diferencia. La reserva y su liquidación quedan como
+# movimientos "reserva-{id}" y "liquidacion-{id}" en el libro de tokens, así
+# que una reserva sin liquidación es una que hay que conciliar.
+#
+# La reserva se crea con pendiente=True y la liquidación la cierra en la
+# misma escritura. Si el proceso muere entre las dos, el barredor encuentra
+# las reservas que siguen pendientes después de RESERVAS_VENCIDAS_SEGUNDOS y
+# devuelve lo retenido con la misma referencia "liquidacion-{id}": si la
+# liquidación real llega después (o llegó antes), choca con esa referencia y
+# el saldo no cambia dos veces.
+#
+# Necesita un índice de grupo de colecciones sobre movimientos
+# (pendiente ==, creado <).
+
+RESERVAS_VENCIDAS_SEGUNDOS = float(os.getenv("RESERVAS_VENCIDAS_SEGUNDOS", "900"))
+RESERVAS_BARRIDO_INTERVALO = float(os.getenv("RESERVAS_BARRIDO_INTERVALO", "300"))
+RESERVAS_BARRIDO_LOTE = int(os.getenv("RESERVAS_BARRIDO_LOTE", "200"))
+
+
+class Reserva:
+    def __init__(self, reserva_id: str, uid: str, retenidos: int):
+        self.reserva_id = reserva_id
+        self.uid = uid
+        self.retenidos = retenidos
+
+
+def reservar_tokens(libro: LibroTokens, uid: str, tokens_minimos: int, tokens_deseados: int) -> Reserva:
+    reserva_id = uuid.uuid4().hex
+    retenidos = libro.debitar(
+        uid,
+        tokens_deseados,
+        'reserva',
+        referencia=f'reserva-{reserva_id}',
+        minimo=tokens_minimos,
+        extra={ 'pendiente': True }
+    )
+    return Reserva(reserva_id, uid, retenidos)
+
+
+def liquidar_reserva(libro: LibroTokens, reserva: Reserva, tokens_usados: int) -> int:
+    # Devuelve lo que realmente se cobró
+    referencia = f'liquidacion-{reserva.reserva_id}'
+    cerrar = f'reserva-{reserva.reserva_id}'
+    sobrante = reserva.retenidos - tokens_usados
+
+    try:
+        if sobrante >= 0:
+            libro.acreditar(reserva.uid, sobrante, 'liquidacion', referencia=referencia, cerrar=cerrar)
+            return tokens_usados
+
+        # El uso real superó lo retenido: se cobra la diferencia hasta donde alcance el saldo
+        extra = libro.debitar(reserva.uid, -sobrante, 'liquidacion', referencia=referencia, minimo=0, cerrar=cerrar)
+        return reserva.retenidos + extra
+
+    except MovimientoDuplicado:
+        # Ya estaba liquidada
+        return tokens_usados
+
+
+def recuperar_reservas_vencidas(libro: LibroTokens, antiguedad: float = RESERVAS_VENCIDAS_SEGUNDOS, limite: int = RESERVAS_BARRIDO_LOTE) -> dict:
+    # Devuelve lo retenido por las reservas que nadie liquidó. Bloqueante.
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    corte = datetime.fromtimestamp(time.time() - antiguedad, timezone.utc)
+    consulta = (
+        libro.db.collection_group('movimientos')
+        .where(filter=FieldFilter('pendiente', '==', True))
+        .where(filter=FieldFilter('creado', '<', corte))
+        .limit(limite)
+    )
+    with medir("firestore_reservas_pendientes"):
+        pendientes = list(consulta.stream())
+
+    resultado = { "revisadas": len(pendientes), "devueltas": 0, "tokens_devueltos": 0, "errores": 0 }
+    for movimiento in pendientes:
+        # usuarios/{uid}/movimientos/reserva-{id}
+        _, uid, _, movimiento_id = movimiento.reference.path.split('/')
+        reserva_id = movimiento_id[len('reserva-'):]
+        cantidad = movimiento.to_dict().get('cantidad', 0)
+        try:
+            libro.acreditar(uid, cantidad, 'reserva_vencida', referencia=f'liquidacion-{reserva_id}', cerrar=movimiento_id)
+            resultado["devueltas"] += 1
+            resultado["tokens_devueltos"] += cantidad
+        except (MovimientoDuplicado, UsuarioNoEncontrado):
+            # Ya estaba liquidada (o el usuario ya no existe): solo se cierra
+            movimiento.reference.set({ 'pendiente': False }, merge=True)
+        except Exception as e:
+            resultado["errores"] += 1
+            print(f"⚠️ No se pudo devolver la reserva vencida {reserva_id}:", str(e))
+    return resultado
+
+
+class BarredorReservas:
+    def __init__(self, libro: LibroTokens):
+        self.libro = libro
+        self._tarea = None
+        self.barridos = 0
+        self.devueltas = 0
+        self.tokens_devueltos = 0
+        self.errores = 0
+
+    def barrer(self) -> dict:
+        resultado = recuperar_reservas_vencidas(self.libro)
+        self.barridos += 1
+        self.devueltas += resultado["devueltas"]
+        self.tokens_devueltos += resultado["tokens_devueltos"]
+        self.errores += resultado["errores"]
+        if resultado["devueltas"]:
+            print(f"✅ Se devolvieron {resultado['tokens_devueltos']} tokens de {resultado['devueltas']} reservas vencidas")
+        return resultado
+
+    async def _barrer_periodicamente(self, intervalo: float):
+        while True:
+            await asyncio.sleep(intervalo)
+            try:
+                await asyncio.to_thread(self.barrer)
+            except Exception as e:
+                self.errores += 1
+                print("❌ No se pudieron revisar las reservas vencidas:", str(e))
+
+    async def iniciar(self, intervalo: float = RESERVAS_BARRIDO_INTERVALO):
+        # Con intervalo 0 no se barre
+        if self._tarea is None and intervalo > 0:
+            self._tarea = asyncio.create_task(self._barrer_periodicamente(intervalo))
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+
+    def estadisticas(self) -> dict:
+        return {
+            "barridos": self.barridos,
+            "devueltas": self.devueltas,
+            "tokens_devueltos": self.tokens_devueltos,
+            "errores": self.errores
+        }
@@ -0,0 +1,196 @@
+import asyncio
+import os
+import threading
+import time
+
+from fastapi.responses import JSONResponse
+
+# =========================
+# Recursos con inicialización perezosa
+# =========================
+# El cliente de Firestore y el tokenizador se crean la primera vez que se
+# usan (con lock, una sola vez por proceso) y no al importar el módulo, así
+# el proceso empieza a aceptar conexiones sin esperarlos.
+#
+# MODO_CALENTAMIENTO decide qué pasa al arrancar:
+# - "segundo_plano" (por defecto): se cargan en un hilo mientras ya se atiende.
+# - "bloqueante": el arranque espera a que estén cargados (comportamiento anterior).
+# - "perezoso": nada se carga hasta la primera solicitud que lo necesite.
+#
+# /salud/vivo/ responde siempre; /salud/listo/ responde 503 hasta que todo
+# está cargado, para que el balanceador no mande tráfico a un proceso frío.
+# Lo que falla al calentar se reintenta en segundo plano con espera creciente
+# (hasta ESPERA_MAX_CALENTAMIENTO segundos), así un fallo pasajero no deja el
+# proceso en 503 hasta reiniciarlo.
+#
+# firebase_admin y google.cloud.firestore tardan en importarse, así que
+# tampoco se importan al cargar los módulos: `firestore` es un proxy del
+# módulo firebase_admin.firestore que lo importa en el primer uso. Al
+# calentar, además de crear el cliente se hace una lectura barata para abrir
+# el canal gRPC (TLS y autenticación) antes de la primera solicitud.
+
+RUTA_CREDENCIALES = os.getenv(
+    "FIREBASE_CREDENCIALES", "/etc/secrets/quizforge-bf3c3-firebase-adminsdk-fbsvc-7b3f56d424"
+)
+MODO_CALENTAMIENTO = os.getenv("MODO_CALENTAMIENTO", "segundo_plano")
+ESPERA_MAX_CALENTAMIENTO = float(os.getenv("ESPERA_MAX_CALENTAMIENTO", "60"))
+
+INICIO_PROCESO = time.monotonic()
+
+
+class RecursoPerezoso:
+    def __init__(self, nombre: str, fabrica):
+        self.nombre = nombre
+        self._fabrica = fabrica
+        self._valor = None
+        self._listo = False
+        self._lock = threading.Lock()
+        self.segundos_carga = None
+        self.error = None
+
+    def obtener(self):
+        if self._listo:
+            return self._valor
+
+        with self._lock:
+            if not self._listo:
+                inicio = time.perf_counter()
+                try:
+                    self._valor = self._fabrica()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.segundos_carga = time.perf_counter() - inicio
+                self.error = None
+                self._listo = True
+        return self._valor
+
+    @property
+    def listo(self) -> bool:
+        return self._listo
+
+    def estado(self) -> dict:
+        return {
+            "listo": self._listo,
+            "segundos_carga": round(self.segundos_carga, 3) if self.segundos_carga is not None else None,
+            "error": self.error
+        }
+
+
+class ProxyPerezoso:
+    # Se comporta como el objeto real; lo crea en el primer acceso a un atributo
+    def __init__(self, recurso: RecursoPerezoso):
+        object.__setattr__(self, "_recurso", recurso)
+
+    def __getattr__(self, nombre: str):
+        return getattr(self._recurso.obtener(), nombre)
+
+
+# ---- Firestore ----
+
+def _importar_sdk_firestore():
+    from firebase_admin import firestore as modulo
+    return modulo
+
+
+def _crear_firestore():
+    import firebase_admin
+    from firebase_admin import credentials
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(RUTA_CREDENCIALES)
+        firebase_admin.initialize_app(cred)
+    cliente = firestore.client()
+
+    if MODO_CALENTAMIENTO != "perezoso":
+        # El cliente no se conecta hasta el primer RPC: se abre el canal aquí
+        try:
+            cliente.collection("_calentamiento").document("_calentamiento").get()
+        except Exception as e:
+            print("⚠️ La lectura de calentamiento de Firestore falló:", str(e))
+    return cliente
+
+
+# SERVER_TIMESTAMP, Increment, transactional... sin importar el SDK al arrancar
+firestore = ProxyPerezoso(RecursoPerezoso("sdk_firestore", _importar_sdk_firestore))
+
+recurso_firestore = RecursoPerezoso("firestore", _crear_firestore)
+db = ProxyPerezoso(recurso_firestore)
+
+
+# =========================
+# Calentamiento y salud
+# =========================
+
+_tareas_calentamiento = set()
+
+
+def _calentar(pasos: tuple) -> tuple:
+    # Devuelve los pasos que fallaron
+    fallidos = []
+    for paso in pasos:
+        if isinstance(paso, RecursoPerezoso):
+            nombre, funcion = paso.nombre, paso.obtener
+        else:
+            nombre, funcion = paso.__qualname__, paso
+        inicio = time.perf_counter()
+        try:
+            funcion()
+        except Exception as e:
+            print(f"❌ Falló el calentamiento de {nombre}:", str(e))
+            fallidos.append(paso)
+        else:
+            print(f"✅ {nombre} listo en {time.perf_counter() - inicio:.2f} s")
+    return tuple(fallidos)
+
+
+async def _reintentar_calentamiento(pasos: tuple):
+    # Mientras tanto, la primera solicitud que lo necesite también lo intenta
+    espera = 1.0
+    while pasos:
+        print(f"⚠️ Se reintenta el calentamiento en {espera:.0f} s")
+        await asyncio.sleep(espera)
+        espera = min(espera * 2, ESPERA_MAX_CALENTAMIENTO)
+        # Un recurso que ya cargó una solicitud no se vuelve a cargar
+        pasos = tuple(p for p in pasos if not (isinstance(p, RecursoPerezoso) and p.listo))
+        if pasos:
+            pasos = await asyncio.to_thread(_calentar, pasos)
+
+
+async def _calentar_en_segundo_plano(pasos: tuple):
+    await _reintentar_calentamiento(await asyncio.to_thread(_calentar, pasos))
+
+
+def _lanzar(corrutina):
+    tarea = asyncio.create_task(corrutina)
+    _tareas_calentamiento.add(tarea)
+    tarea.add_done_callback(_tareas_calentamiento.discard)
+
+
+async def iniciar_calentamiento(*pasos):
+    # pasos: recursos o funciones síncronas que se ejecutan en orden en un hilo
+    if MODO_CALENTAMIENTO == "perezoso":
+        return
+    if MODO_CALENTAMIENTO == "bloqueante":
+        fallidos = await asyncio.to_thread(_calentar, pasos)
+        if fallidos:
+            _lanzar(_reintentar_calentamiento(fallidos))
+        return
+
+    _lanzar(_calentar_en_segundo_plano(pasos))
+
+
+def instalar_salud(app, recursos: list):
+    @app.get("/salud/vivo/")
+    async def salud_vivo():
+        return { "estado": "vivo", "segundos_activo": round(time.monotonic() - INICIO_PROCESO, 1) }
+
+    @app.get("/salud/listo/")
+    async def salud_listo():
+        estados = { recurso.nombre: recurso.estado() for recurso in recursos }
+        # En modo perezoso los recursos se cargan con la primera solicitud que los use
+        listo = MODO_CALENTAMIENTO == "perezoso" or all(recurso.listo for recurso in recursos)
+        return JSONResponse(
+            { "estado": "listo" if listo else "calentando", "recursos": estados },
+            status_code=200 if listo else 503
+        )
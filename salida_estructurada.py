@@ -0,0 +1,200 @@
+import os
+import re
+
+import orjson
+from pydantic import BaseModel, Field, ValidationError
+
+from parser_incremental import ParserPreguntasIncremental
+
+# =========================
+# Salida estructurada de OpenAI
+# =========================
+# Con MODO_SALIDA="funciones" (por defecto) las preguntas y las
+# clasificaciones se piden con function calling: el modelo entrega sus
+# argumentos según un esquema JSON y no texto libre. Con "texto" se vuelve
+# al JSON dentro del mensaje.
+#
+# En los dos modos la respuesta pasa por el mismo parser: orjson y luego
+# modelos de Pydantic. El parser acepta bloques ``` o texto alrededor del
+# JSON, comas colgantes y respuestas cortadas por max_tokens (se rescatan
+# las preguntas que sí se cerraron). Así una respuesta ya pagada no termina
+# en advertencia solo por el formato.
+
+MODO_SALIDA = os.getenv("MODO_SALIDA", "funciones")
+
+CERCO = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.S)
+COMA_COLGANTE = re.compile(r",\s*([}\]])")
+
+
+class ErrorSalida(ValueError):
+    pass
+
+
+# ---- Modelos ----
+
+class Pregunta(BaseModel):
+    pregunta: str = Field(min_length=1)
+    opciones: list[str] = []
+    respuesta_correcta: str = Field(min_length=1)
+
+
+class Clasificacion(BaseModel):
+    # { materia: { subrama: [palabras] } }
+    clasificadas: dict[str, dict[str, list[str]]] = {}
+
+
+# ---- Esquemas para function calling ----
+
+ESQUEMA_CLASIFICADAS = {
+    "type": "object",
+    "description": "Materia -> subrama -> palabras clave.",
+    "additionalProperties": {
+        "type": "object",
+        "additionalProperties": { "type": "array", "items": { "type": "string" } }
+    }
+}
+
+FUNCION_PREGUNTAS = {
+    "name": "entregar_preguntas",
+    "description": "Entrega las preguntas de opción múltiple generadas a partir del texto.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "preguntas": {
+                "type": "array",
+                "maxItems": 10,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "pregunta": { "type": "string" },
+                        "opciones": { "type": "array", "items": { "type": "string" } },
+                        "respuesta_correcta": { "type": "string" }
+                    },
+                    "required": ["pregunta", "opciones", "respuesta_correcta"]
+                }
+            },
+            "advertencia": {
+                "type": "string",
+                "description": "Solo si el texto no permite generar preguntas; en ese caso preguntas va vacío."
+            }
+        },
+        "required": ["preguntas"]
+    }
+}
+
+FUNCION_CLASIFICACION = {
+    "name": "entregar_clasificacion",
+    "description": "Entrega las palabras clave clasificadas por materia y subrama.",
+    "parameters": {
+        "type": "object",
+        "properties": { "clasificadas": ESQUEMA_CLASIFICADAS },
+        "required": ["clasificadas"]
+    }
+}
+
+FUNCION_CLASIFICACION_LOTE = {
+    "name": "entregar_clasificaciones",
+    "description": "Entrega la clasificación de cada conjunto, indexada por su número.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "resultados": {
+                "type": "object",
+                "additionalProperties": {
+                    "type": "object",
+                    "properties": { "clasificadas": ESQUEMA_CLASIFICADAS },
+                    "required": ["clasificadas"]
+                }
+            }
+        },
+        "required": ["resultados"]
+    }
+}
+
+
+# ---- Lectura de la respuesta ----
+
+def contenido_respuesta(response: dict) -> str:
+    # Argumentos de la función si el modelo la llamó; si no, el texto del mensaje
+    mensaje = response["choices"][0]["message"]
+    llamada = mensaje.get("function_call")
+    if llamada:
+        return llamada.get("arguments") or ""
+    return mensaje.get("content") or ""
+
+
+def cargar_json(texto: str):
+    try:
+        return orjson.loads(texto)
+    except orjson.JSONDecodeError:
+        pass
+
+    cerco = CERCO.search(texto)
+    candidato = cerco.group(1) if cerco else texto
+    inicio, fin = candidato.find("{"), candidato.rfind("}")
+    if inicio == -1 or fin < inicio:
+        raise ErrorSalida("La respuesta no contiene JSON.")
+    candidato = candidato[inicio:fin + 1]
+
+    try:
+        return orjson.loads(candidato)
+    except orjson.JSONDecodeError:
+        pass
+
+    try:
+        return orjson.loads(COMA_COLGANTE.sub(r"\1", candidato))
+    except orjson.JSONDecodeError as e:
+        raise ErrorSalida(f"JSON inválido: {e}") from e
+
+
+def validar_pregunta(objeto):
+    # Devuelve la pregunta como dict si está completa; si no, None
+    try:
+        return Pregunta.model_validate(objeto).model_dump()
+    except ValidationError:
+        return None
+
+
+def leer_preguntas(texto: str) -> tuple:
+    # Devuelve (preguntas completas, cuántas venían). ErrorSalida si no hay JSON de preguntas.
+    try:
+        datos = cargar_json(texto)
+        recibidas = datos.get("preguntas") if isinstance(datos, dict) else None
+        if recibidas is not None and not isinstance(recibidas, list):
+            raise ErrorSalida("'preguntas' no es una lista.")
+    except ErrorSalida:
+        # Respuesta cortada: se rescatan los objetos que alcanzaron a cerrarse
+        recibidas = ParserPreguntasIncremental().alimentar(texto)
+        if not recibidas:
+            raise
+
+    recibidas = recibidas or []
+    validas = [p for p in map(validar_pregunta, recibidas) if p is not None]
+    return validas, len(recibidas)
+
+
+def serializar_preguntas(preguntas: list) -> str:
+    return orjson.dumps({ "preguntas": preguntas }).decode("utf-8")
+
+
+def leer_clasificacion(texto: str) -> dict:
+    try:
+        return Clasificacion.model_validate(cargar_json(texto)).model_dump()
+    except ValidationError as e:
+        raise ErrorSalida(f"Clasificación inválida: {e.error_count()} errores") from e
+
+
+def leer_clasificacion_lote(texto: str, total: int) -> list:
+    # Un resultado por conjunto; None en los que falten o no sean válidos
+    datos = cargar_json(texto)
+    resultados = datos.get("resultados") if isinstance(datos, dict) else None
+    if not isinstance(resultados, dict):
+        raise ErrorSalida("La respuesta no trae 'resultados'.")
+
+    clasificaciones = []
+    for i in range(total):
+        try:
+            clasificaciones.append(Clasificacion.model_validate(resultados.get(str(i))).model_dump())
+        except ValidationError:
+            clasificaciones.append(None)
+    return clasificaciones
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# Los módulos de la app viven en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebase_admin import firestore
+
+from benchmark.firestore_memoria import FirestoreMemoria, transactional
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # Firestore en memoria del benchmark; sus transacciones reemplazan a firestore.transactional
+    monkeypatch.setattr(firestore, "transactional", transactional)
+    return FirestoreMemoria()
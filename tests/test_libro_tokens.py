@@ -0,0 +1,104 @@
+import pytest
+
+from libro_tokens import LibroTokens, MovimientoDuplicado, SaldoInsuficiente, UsuarioNoEncontrado
+from presupuesto import liquidar_reserva, recuperar_reservas_vencidas, reservar_tokens
+
+
+def saldo(db, uid: str) -> int:
+    return db._docs[f"usuarios/{uid}"]["tokens"]
+
+
+def movimientos(db, uid: str) -> dict:
+    prefijo = f"usuarios/{uid}/movimientos/"
+    return { ruta[len(prefijo):]: datos for ruta, datos in db._docs.items() if ruta.startswith(prefijo) }
+
+
+@pytest.fixture
+def libro(db):
+    db.sembrar("usuarios/u", { "tokens": 1000 })
+    return LibroTokens(db)
+
+
+# ---- Créditos y débitos ----
+
+def test_credito_repetido_no_suma_dos_veces(db, libro):
+    libro.acreditar("u", 500, "paypal_webhook", referencia="paypal-orden-1")
+    with pytest.raises(MovimientoDuplicado):
+        libro.acreditar("u", 500, "paypal_webhook", referencia="paypal-orden-1")
+
+    assert saldo(db, "u") == 1500
+    assert list(movimientos(db, "u")) == ["paypal-orden-1"]
+
+
+def test_credito_a_usuario_inexistente(db, libro):
+    with pytest.raises(UsuarioNoEncontrado):
+        libro.acreditar("nadie", 500, "paypal_webhook", referencia="paypal-orden-2")
+    assert "usuarios/nadie" not in db._docs
+
+
+def test_debito_sin_saldo_no_cambia_nada(db, libro):
+    with pytest.raises(SaldoInsuficiente):
+        libro.debitar("u", 1001, "generacion", referencia="gen-1")
+
+    assert saldo(db, "u") == 1000
+    assert movimientos(db, "u") == {}
+
+
+def test_debito_con_minimo_descuenta_lo_que_alcanza(db, libro):
+    assert libro.debitar("u", 5000, "reserva", minimo=200) == 1000
+    assert saldo(db, "u") == 0
+
+    with pytest.raises(SaldoInsuficiente):
+        libro.debitar("u", 5000, "reserva", minimo=200)
+
+
+def test_debito_repetido(db, libro):
+    libro.debitar("u", 100, "generacion", referencia="gen-1")
+    with pytest.raises(MovimientoDuplicado):
+        libro.debitar("u", 100, "generacion", referencia="gen-1")
+    assert saldo(db, "u") == 900
+
+
+# ---- Reservas ----
+
+def test_reserva_y_liquidacion_parcial(db, libro):
+    reserva = reservar_tokens(libro, "u", 100, 300)
+    assert reserva.retenidos == 300
+    assert saldo(db, "u") == 700
+    assert movimientos(db, "u")[f"reserva-{reserva.reserva_id}"]["pendiente"] is True
+
+    assert liquidar_reserva(libro, reserva, 120) == 120
+    assert saldo(db, "u") == 880
+
+    registro = movimientos(db, "u")
+    assert registro[f"reserva-{reserva.reserva_id}"]["pendiente"] is False
+    assert registro[f"liquidacion-{reserva.reserva_id}"]["cantidad"] == 180
+
+    # Liquidar otra vez (p. ej. un reintento) no devuelve nada más
+    liquidar_reserva(libro, reserva, 120)
+    assert saldo(db, "u") == 880
+
+
+def test_liquidacion_que_supera_lo_retenido(db, libro):
+    reserva = reservar_tokens(libro, "u", 50, 100)
+    assert liquidar_reserva(libro, reserva, 150) == 150
+    assert saldo(db, "u") == 850
+
+
+def test_reserva_vencida_se_devuelve_una_vez(db, libro):
+    olvidada = reservar_tokens(libro, "u", 100, 300)
+    liquidada = reservar_tokens(libro, "u", 100, 200)
+    liquidar_reserva(libro, liquidada, 50)
+    assert saldo(db, "u") == 650
+
+    # Todavía no vence
+    assert recuperar_reservas_vencidas(libro, antiguedad=60)["devueltas"] == 0
+
+    resultado = recuperar_reservas_vencidas(libro, antiguedad=0)
+    assert resultado["devueltas"] == 1 and resultado["tokens_devueltos"] == 300
+    assert saldo(db, "u") == 950
+
+    # La liquidación que llega tarde choca con la devolución
+    liquidar_reserva(libro, olvidada, 100)
+    assert saldo(db, "u") == 950
+    assert recuperar_reservas_vencidas(libro, antiguedad=0)["revisadas"] == 0
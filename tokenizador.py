@@ -0,0 +1,64 @@
+import os
+
+# tiktoken lee las tablas BPE de aquí (y solo las descarga si faltan).
+# `python tokenizador.py` las deja en esta carpeta durante el build, así el
+# arranque no depende de la red.
+os.environ.setdefault(
+    "TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+)
+
+import tiktoken
+
+from recursos import RecursoPerezoso
+
+# =========================
+# Conteo de tokens con tiktoken
+# =========================
+# tiktoken 0.5.1 no conoce gpt-4o, así que se usa el codificador de gpt-4
+# (cl100k_base) como estimación, igual que /contar-tokens/.
+# El codificador se carga una sola vez por proceso (al calentar o en el primer
+# uso) y se comparte entre todas las solicitudes.
+
+MODELO_TOKENIZADOR = "gpt-4"
+HILOS_LOTE = int(os.getenv("TOKENIZADOR_HILOS", "8"))
+
+# Según la guía de OpenAI: cada mensaje agrega 3 tokens de formato y la
+# respuesta se prepara con otros 3.
+TOKENS_POR_MENSAJE = 3
+TOKENS_RESPUESTA = 3
+
+recurso_codificador = RecursoPerezoso("tokenizador", lambda: tiktoken.encoding_for_model(MODELO_TOKENIZADOR))
+
+
+def obtener_codificador():
+    return recurso_codificador.obtener()
+
+
+def precargar():
+    obtener_codificador()
+
+
+def contar_tokens(texto: str) -> int:
+    # encode_ordinary cuenta "<|endoftext|>" y similares como texto normal
+    return len(obtener_codificador().encode_ordinary(texto))
+
+
+def contar_tokens_lote(textos: list) -> list:
+    # encode_ordinary_batch reparte el trabajo en hilos que liberan el GIL
+    codificados = obtener_codificador().encode_ordinary_batch(textos, num_threads=HILOS_LOTE)
+    return [len(tokens) for tokens in codificados]
+
+
+def contar_tokens_mensajes(mensajes: list) -> int:
+    total = TOKENS_RESPUESTA
+    for mensaje in mensajes:
+        total += TOKENS_POR_MENSAJE
+        for valor in mensaje.values():
+            total += contar_tokens(valor)
+    return total
+
+
+if __name__ == "__main__":
+    # Descarga previa de las tablas BPE (paso de build)
+    precargar()
+    print(f"✅ Tablas de {MODELO_TOKENIZADOR} en {os.environ['TIKTOKEN_CACHE_DIR']}")
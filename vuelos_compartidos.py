@@ -0,0 +1,49 @@
+import asyncio
+
+# =========================
+# Llamadas compartidas (single-flight)
+# =========================
+# Cuando un profesor comparte un texto, muchos alumnos piden preguntas del
+# mismo texto casi a la vez. La primera solicitud (líder) hace la llamada a
+# OpenAI y las que llegan mientras tanto con la misma clave esperan ese mismo
+# resultado en vez de hacer otra llamada. Cada una se cobra por separado.
+#
+# Solo se comparte si el límite de la llamada en curso (max_tokens) no supera
+# el de quien se une: así nadie paga más de lo que tenía reservado.
+# La llamada corre en su propia tarea: si el líder se desconecta, los demás
+# siguen esperando el resultado.
+
+
+class VuelosCompartidos:
+    def __init__(self):
+        self._en_curso = {}
+        self.lideres = 0
+        self.seguidores = 0
+
+    async def ejecutar(self, clave: str, limite: int, fabrica):
+        # fabrica() -> corrutina; devuelve (resultado, compartido)
+        en_curso = self._en_curso.get(clave)
+        if en_curso is not None and en_curso[1] <= limite:
+            self.seguidores += 1
+            return await asyncio.shield(en_curso[0]), True
+
+        tarea = asyncio.ensure_future(fabrica())
+        self.lideres += 1
+        if en_curso is None:
+            self._en_curso[clave] = (tarea, limite)
+            tarea.add_done_callback(lambda _: self._terminar(clave, tarea))
+        return await asyncio.shield(tarea), False
+
+    def _terminar(self, clave: str, tarea):
+        en_curso = self._en_curso.get(clave)
+        if en_curso is not None and en_curso[0] is tarea:
+            del self._en_curso[clave]
+
+    def estadisticas(self) -> dict:
+        total = self.lideres + self.seguidores
+        return {
+            "en_curso": len(self._en_curso),
+            "llamadas": self.lideres,
+            "compartidas": self.seguidores,
+            "tasa_compartidas": self.seguidores / total if total else 0.0
+        }